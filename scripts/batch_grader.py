@@ -0,0 +1,247 @@
+from test_helper import TestLimits, TimeLimitExceeded, TIMEOUT, OOM, FAIL, PrettyError, enforce_limits, \
+    load_compiled_suite
+from spec_catalogue import resolve_spec
+from shared_suite import SharedSuite, AttachedSuite
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+
+SUBMISSION_EXTENSIONS = (".py", ".ipynb")
+COLUMNS = ("student", "passed", "total", "visible", "secret", "status")
+DEFAULT_TIMEOUT = 10
+# the status of a submission that called sys.exit() (or raised KeyboardInterrupt) while loading or being tested
+EXITED = "exited"
+# the status of a submission that took its worker process down with it, e.g. with os._exit() or a segfault
+CRASHED = "crashed"
+# times a submission is graded again after a worker running alongside it crashed, before it's graded on its own
+DEFAULT_RETRIES = 2
+
+# set once per worker process by _init_worker, attached to the suite in shared memory rather than a copy of it
+_worker_suite = None
+_worker_limits = None
+
+
+def find_submissions(directory):
+    submissions = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.endswith(SUBMISSION_EXTENSIONS) and not file.startswith("."):
+                submissions.append(os.path.join(root, file))
+    return sorted(submissions)
+
+
+def get_submission_code(filename):
+    """
+        Returns a list of code blocks, one per notebook cell (or the whole file for .py)
+        IPython magics and shell escapes are dropped since they can't run outside a kernel
+    """
+    with open(filename, "r", encoding="utf-8") as submission_file:
+        if not filename.endswith(".ipynb"):
+            return [submission_file.read()]
+        notebook = json.load(submission_file)
+
+    blocks = []
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") != "code":
+            continue
+        source = cell.get("source", "")
+        if isinstance(source, list):
+            source = "".join(source)
+        lines = [line for line in source.split("\n") if not line.lstrip().startswith(("%", "!"))]
+        blocks.append("\n".join(lines))
+    return blocks
+
+
+def load_submission_function(filename, name, limits=None):
+    return load_function(get_submission_code(filename), name, limits)[0]
+
+
+def load_function(blocks, name, limits=None):
+    """
+        Returns (the function called name or None, whether any block tried to exit)
+    """
+    namespace = {"__name__": "__submission__"}
+    exited = False
+    # notebooks are full of half-finished exercises, so a broken cell shouldn't stop the rest loading
+    with contextlib.redirect_stdout(io.StringIO()):
+        for block in blocks:
+            try:
+                with enforce_limits(limits):
+                    exec(block, namespace)
+            except (Exception, TimeLimitExceeded):
+                pass
+            except (SystemExit, KeyboardInterrupt):
+                # in a notebook this only stops the cell, it mustn't stop grading everyone else
+                exited = True
+    return namespace.get(name), exited
+
+
+def run_submission_test(fn, test):
+    """
+        Returns (passed, whether the function tried to exit), an exit fails the test
+    """
+    try:
+        return test.run(fn), False
+    except (SystemExit, KeyboardInterrupt) as e:
+        test.record_run(PrettyError(e, ""), False, FAIL)
+        return False, True
+
+
+def count_passes(fn, tests):
+    """
+        Returns (number of tests passed, whether the function tried to exit in any of them)
+    """
+    runs = [run_submission_test(fn, test) for test in tests]
+    return sum(1 for passed, _ in runs if passed), any(exited for _, exited in runs)
+
+
+def get_student(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def new_result(suite, student, status="ok"):
+    return {"student": student, "passed": 0, "total": len(suite.get_tests()) + len(suite.get_secret_tests()),
+            "visible": "", "secret": "", "status": status}
+
+
+def grade_submission(suite, filename, limits=None):
+    try:
+        blocks = get_submission_code(filename)
+    except (OSError, ValueError, SyntaxError) as e:
+        return new_result(suite, get_student(filename), f"could not load: {e.__class__.__name__}")
+    return grade_code(suite, get_student(filename), blocks, limits)
+
+
+def grade_code(suite, student, blocks, limits=None):
+    """
+        Grades code that has already been read from a submission, see get_submission_code
+    """
+    result = new_result(suite, student)
+
+    # tests hand each run a fresh copy of their inputs, so they can be reused between students
+    tests = suite.get_tests()
+    secret_tests = suite.get_secret_tests()
+    for test in tests + secret_tests:
+        test.add_default_limits(limits)
+
+    fn, exited = load_function(blocks, suite.get_name(), limits)
+    if not callable(fn):
+        result["status"] = f"no function {suite.get_name()}" if not exited else EXITED
+        return result
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        visible, visible_exited = count_passes(fn, tests)
+        secret, secret_exited = count_passes(fn, secret_tests)
+    result["passed"] = visible + secret
+    result["visible"] = f"{visible}/{len(tests)}"
+    result["secret"] = f"{secret}/{len(secret_tests)}"
+
+    outcomes = {test.get_outcome() for test in tests + secret_tests}
+    problems = [outcome for outcome in (TIMEOUT, OOM) if outcome in outcomes]
+    if exited or visible_exited or secret_exited:
+        problems.append(EXITED)
+    if problems:
+        result["status"] = "/".join(problems)
+    return result
+
+
+def _init_worker(suite_name, limits):
+    global _worker_suite, _worker_limits
+    _worker_suite = AttachedSuite(suite_name)
+    _worker_limits = limits
+
+
+def _grade_in_worker(filename):
+    return grade_submission(_worker_suite, filename, _worker_limits)
+
+
+def grade_batch(suite_name, submissions, workers=None, limits=None):
+    """
+        Returns {filename: result} for the submissions graded before a worker crashed (if one did),
+        and whether one did. A crash stops the whole pool, so there's no telling whose submission caused it.
+    """
+    results = {}
+    crashed = False
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(suite_name, limits)) as pool:
+        futures = {pool.submit(_grade_in_worker, filename): filename for filename in submissions}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except BrokenProcessPool:
+                crashed = True
+    return results, crashed
+
+
+def grade_directory(spec_filename, directory, workers=None, limits=None, retries=DEFAULT_RETRIES):
+    """
+        After a worker crashes, the submissions it didn't finish are graded again in a new pool, last if
+        they were caught up in earlier crashes too. One caught up in more than retries crashes is graded on
+        its own, and if that crashes as well it was the cause.
+    """
+    suite = load_compiled_suite(resolve_spec(spec_filename))
+    submissions = find_submissions(directory)
+
+    if workers == 1:
+        return [grade_submission(suite, filename, limits) for filename in submissions]
+
+    results = {}
+    crashes = {filename: 0 for filename in submissions}
+    # one copy of the tests however many workers there are, each only unpickles the test it's running
+    with SharedSuite(suite) as shared:
+        pending = list(submissions)
+        while pending:
+            pending.sort(key=lambda filename: crashes[filename])
+            batch = pending if crashes[pending[-1]] <= retries else pending[-1:]
+            graded, crashed = grade_batch(shared.get_name(), batch, workers, limits)
+            results.update(graded)
+            pending = [filename for filename in pending if filename not in graded]
+            if crashed and len(batch) == 1:
+                results[batch[0]] = new_result(suite, get_student(batch[0]), CRASHED)
+                pending.remove(batch[0])
+            elif crashed:
+                for filename in batch:
+                    if filename not in graded:
+                        crashes[filename] += 1
+    return [results[filename] for filename in submissions]
+
+
+def format_table(results, columns=COLUMNS):
+    rows = [columns] + [tuple(str(result[column]) for column in columns) for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def write_csv(results, filename, columns=COLUMNS):
+    with open(filename, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade a directory of submissions against one test spec.")
+    parser.add_argument("spec", help="test spec file or name, e.g. 'Chapter 2/questions/2.5/collatz' or collatz")
+    parser.add_argument("submissions", help="directory of .py or .ipynb submissions")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: one per core)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds allowed per test, unless the spec sets its own *limits")
+    parser.add_argument("--memory", type=float, default=None,
+                        help="megabytes allowed per test, unless the spec sets its own *limits")
+    parser.add_argument("--csv", help="also write the results table to this file")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.submissions):
+        raise RuntimeError("Submissions must be a directory.")
+
+    results = grade_directory(args.spec, args.submissions, args.workers, TestLimits(args.timeout, args.memory))
+    print(format_table(results))
+    if args.csv:
+        write_csv(results, args.csv)
@@ -0,0 +1,214 @@
+from test_helper import TestSpec
+from function_tester import format_test_output
+from grading_magics import GradingSession
+import interactive_questions
+import argparse
+import contextlib
+import copy
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPEC_PATTERN = os.path.join("Chapter *", "questions", "*", "*")
+QUESTION_PATTERN = os.path.join("Chapter *", "questions", "*q.txt")
+FUNCTION_TESTER = os.path.join(ROOT, "scripts", "function_tester.py")
+
+
+def find_specs(root=ROOT):
+    paths = glob.glob(os.path.join(root, SPEC_PATTERN))
+    return sorted(os.path.relpath(path, root) for path in paths if os.path.isfile(path))
+
+
+def find_question_files(root=ROOT):
+    return sorted(os.path.relpath(path, root) for path in glob.glob(os.path.join(root, QUESTION_PATTERN)))
+
+
+def time_stage(fn, repeat, warmup):
+    """
+        Returns (timings in seconds, result of the last call)
+    """
+    result = None
+    for _ in range(warmup):
+        result = fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def summarise(timings):
+    return {"min": min(timings), "median": statistics.median(timings),
+            "mean": statistics.mean(timings), "max": max(timings), "runs": timings}
+
+
+def benchmark_spec(filename, repeat=5, warmup=1):
+    stages = {}
+
+    timings, spec = time_stage(lambda: TestSpec(filename), repeat, warmup)
+    stages["parse"] = summarise(timings)
+
+    timings, solution = time_stage(spec.get_solution_function, repeat, warmup)
+    stages["reference_exec"] = summarise(timings)
+
+    timings, (tests, secret_tests) = time_stage(lambda: spec.generate_tests(solution), repeat, warmup)
+    stages["generate"] = summarise(timings)
+    all_tests = tests + secret_tests
+
+    # a test's first run copies its inputs (generating any matrices) and later runs reuse the copy,
+    # so first_run times copies of the tests that haven't been run, and execute times runs after the first
+    timings, _ = time_stage(lambda: [copy.copy(test).run(solution) for test in all_tests], repeat, warmup)
+    stages["first_run"] = summarise(timings)
+
+    timings, _ = time_stage(lambda: [test.run(solution) for test in all_tests], repeat, warmup)
+    stages["execute"] = summarise(timings)
+
+    timings, _ = time_stage(lambda: [format_test_output(test) for test in all_tests], repeat, warmup)
+    stages["format"] = summarise(timings)
+
+    return {"kind": "spec", "path": filename, "tests": len(tests), "secret_tests": len(secret_tests),
+            "stages": stages}
+
+
+def benchmark_question_file(filename, repeat=5, warmup=1, questions=10):
+    stages = {}
+
+    timings, formats = time_stage(lambda: interactive_questions.load_formats_from_file(filename), repeat, warmup)
+    stages["parse"] = summarise(timings)
+
+    # generating runs the question code, which may print
+    with contextlib.redirect_stdout(io.StringIO()):
+        timings, _ = time_stage(lambda: interactive_questions.get_questions(formats, questions), repeat, warmup)
+    stages["generate"] = summarise(timings)
+
+    return {"kind": "questions", "path": filename, "formats": len(formats), "stages": stages}
+
+
+def run_script(filename, argv, namespace):
+    """
+        What %run -i does: read and compile the script, then run it as __main__ in the notebook's namespace
+    """
+    with open(filename, "r") as script_file:
+        code = compile(script_file.read(), filename, "exec")
+    saved_argv = sys.argv
+    sys.argv = [filename] + argv
+    namespace["__name__"] = "__main__"
+    try:
+        exec(code, namespace)
+    finally:
+        sys.argv = saved_argv
+
+
+def benchmark_latency(filename, repeat=5, warmup=1):
+    """
+        The time from clicking a grading cell to seeing the results, with the spec's own solution as
+        the function: through %run -i function_tester.py, and through the resident %grade magic
+        Repeat clicks with an unchanged function replay the previous results; --fresh runs every test again
+    """
+    stages = {}
+    spec = TestSpec(filename)
+    namespace = {spec.get_name(): spec.get_solution_function()}
+    session = GradingSession(namespace)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        timings, _ = time_stage(lambda: run_script(FUNCTION_TESTER, ["--fresh", filename], namespace), repeat, warmup)
+        stages["run_fresh"] = summarise(timings)
+        timings, _ = time_stage(lambda: run_script(FUNCTION_TESTER, [filename], namespace), repeat, warmup)
+        stages["run_replay"] = summarise(timings)
+        timings, _ = time_stage(lambda: session.grade(f"--fresh '{filename}'"), repeat, warmup)
+        stages["magic_fresh"] = summarise(timings)
+        timings, _ = time_stage(lambda: session.grade(f"'{filename}'"), repeat, warmup)
+        stages["magic_replay"] = summarise(timings)
+
+    return {"kind": "latency", "path": filename, "stages": stages}
+
+
+def benchmark_startup(repeat=5, warmup=1):
+    """
+        Starting a kernel-like process and loading the extension, paid once per kernel rather than per click
+    """
+    command = [sys.executable, "-c", "import grading_magics"]
+    scripts = os.path.dirname(FUNCTION_TESTER)
+    timings, _ = time_stage(lambda: subprocess.run(command, cwd=scripts, check=True), repeat, warmup)
+    return {"kind": "startup", "path": "grading_magics", "stages": {"import": summarise(timings)}}
+
+
+def get_commit(root=ROOT):
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(root=ROOT, repeat=5, warmup=1, pattern=None, latency=False):
+    results = []
+    if latency:
+        results.append(benchmark_startup(repeat, warmup))
+    for spec in find_specs(root):
+        if pattern is None or pattern in spec:
+            if latency:
+                results.append(benchmark_latency(os.path.join(root, spec), repeat, warmup))
+            else:
+                results.append(benchmark_spec(os.path.join(root, spec), repeat, warmup))
+            results[-1]["path"] = spec
+    for question_file in find_question_files(root) if not latency else []:
+        if pattern is None or pattern in question_file:
+            results.append(benchmark_question_file(os.path.join(root, question_file), repeat, warmup))
+            results[-1]["path"] = question_file
+
+    return {"commit": get_commit(root), "python": platform.python_version(), "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": repeat, "warmup": warmup,
+            "results": results}
+
+
+def compare(old, new, stat="median"):
+    """
+        Lines of "path stage old new ratio" for every stage in both runs
+    """
+    old_results = {result["path"]: result for result in old["results"]}
+    lines = []
+    for result in new["results"]:
+        if result["path"] not in old_results:
+            continue
+        old_stages = old_results[result["path"]]["stages"]
+        for stage, timing in result["stages"].items():
+            if stage not in old_stages:
+                continue
+            before = old_stages[stage][stat]
+            after = timing[stat]
+            ratio = after / before if before > 0 else float("inf")
+            lines.append(f"{result['path']}\t{stage}\t{before * 1000:.3f}ms\t{after * 1000:.3f}ms\t{ratio:.2f}x")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the grading pipeline for every spec.")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each stage")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs before timing")
+    parser.add_argument("--filter", help="only benchmark paths containing this text")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    parser.add_argument("--latency", action="store_true",
+                        help="time whole grading clicks, %%run against the %%grade magic, instead of each stage")
+    args = parser.parse_args()
+
+    benchmarks = run_benchmarks(ROOT, args.repeat, args.warmup, args.filter, args.latency)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(benchmarks, output_file, indent=1)
+    else:
+        print(json.dumps(benchmarks, indent=1))
+
+    if args.compare:
+        with open(args.compare, "r") as compare_file:
+            print("\n".join(compare(json.load(compare_file), benchmarks)))
@@ -0,0 +1,23 @@
+from interactive_questions import load_formats_from_file, build_pools, save_pools, check_question_space
+import argparse
+import glob
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render quiz questions so quizzes don't run code as they start.")
+    parser.add_argument("files", nargs="*", help="question files (default: every chapter's questions/*q.txt)")
+    parser.add_argument("-n", "--size", type=int, default=50, help="questions to render per format")
+    parser.add_argument("--seed", type=int, default=None, help="render the same pools every time")
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob(os.path.join(ROOT, "Chapter *", "questions", "*q.txt")))
+    for filename in files:
+        formats = load_formats_from_file(filename)
+        pools = build_pools(formats, args.size, seed=args.seed)
+        save_pools(filename, pools)
+        print(f"{filename}: {sum(len(pool) for pool in pools)} questions for {len(formats)} formats")
+        for message in check_question_space(formats):
+            print(f"\t{message}")
@@ -0,0 +1,234 @@
+import math
+import numbers
+import reprlib
+
+# math.isclose's own default, which tests of single numbers have always used
+DEFAULT_REL_TOL = 1e-09
+
+
+class Mismatch:
+    """
+        Where the output first differs from the expected value, e.g. path "[37][12]", and how
+        Only strings, so it can be sent back from a worker process and cached with the test
+    """
+    def __init__(self, path, reason):
+        self.__path = path
+        self.__reason = reason
+
+    def get_path(self):
+        return self.__path
+
+    def get_reason(self):
+        return self.__reason
+
+    def __str__(self):
+        if self.__path == "":
+            return self.__reason
+        return f"at {self.__path}: {self.__reason}"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def short_repr(value):
+    return reprlib.repr(value)
+
+
+def type_name(value):
+    return type(value).__name__
+
+
+def values_equal(expected, actual):
+    # == can raise, or give back something that isn't a bool (e.g. a numpy array)
+    try:
+        return bool(expected == actual)
+    except Exception:
+        return False
+
+
+def fingerprint(obj):
+    """
+        A hashable stand-in for obj, so that inputs that compare equal get equal fingerprints
+        Lists, tuples, dicts and sets are walked; anything else unhashable falls back to its repr
+    """
+    if isinstance(obj, list):
+        return "list", tuple(fingerprint(x) for x in obj)
+    elif isinstance(obj, tuple):
+        return "tuple", tuple(fingerprint(x) for x in obj)
+    elif isinstance(obj, dict):
+        return "dict", frozenset((fingerprint(k), fingerprint(v)) for k, v in obj.items())
+    elif isinstance(obj, (set, frozenset)):
+        # sets and frozensets compare equal, so share a tag
+        return "set", frozenset(fingerprint(x) for x in obj)
+    try:
+        hash(obj)
+        return obj
+    except TypeError:
+        return "repr", type(obj).__name__, repr(obj)
+
+
+def sort_items(items):
+    try:
+        return sorted(items)
+    except TypeError:
+        return sorted(items, key=repr)
+
+
+class Comparator:
+    """
+        Compares a test's output with the expected value, stopping at the first difference
+        rel_tol/abs_tol of None means numbers must be exactly equal. recursive applies the tolerance
+        inside lists, tuples and dicts too, otherwise only to an output that is a single number.
+        unordered ignores the order of a list or tuple output, set_like also ignores repeats and its type.
+        strict requires the same types all the way down, so 1 is not 1.0 and a tuple is not a list.
+    """
+    def __init__(self, rel_tol=None, abs_tol=0.0, recursive=True, unordered=False, set_like=False, strict=False):
+        self.__rel_tol = rel_tol
+        self.__abs_tol = abs_tol
+        self.__recursive = recursive
+        self.__unordered = unordered
+        self.__set_like = set_like
+        self.__strict = strict
+
+    def get_rel_tol(self):
+        return self.__rel_tol
+
+    def with_tolerance(self, rel_tol, abs_tol=0.0):
+        return Comparator(rel_tol, abs_tol, True, self.__unordered, self.__set_like, self.__strict)
+
+    def with_options(self, unordered=None, set_like=None, strict=None):
+        return Comparator(self.__rel_tol, self.__abs_tol, self.__recursive,
+                          self.__unordered if unordered is None else unordered,
+                          self.__set_like if set_like is None else set_like,
+                          self.__strict if strict is None else strict)
+
+    def compare(self, expected, actual):
+        """
+            None if actual is close enough to expected, otherwise the first Mismatch
+        """
+        if self.__set_like:
+            return self.__compare_sets(expected, actual, "")
+        if self.__unordered and isinstance(expected, (list, tuple)) and isinstance(actual, (list, tuple)):
+            if isinstance(actual, list) != isinstance(expected, list) or \
+                    (self.__strict and type(expected) is not type(actual)):
+                return Mismatch("", f"expected type {type_name(expected)} but got type {type_name(actual)}")
+            expected, actual = sort_items(expected), sort_items(actual)
+            # once sorted, positions only make sense in the sorted lists
+            return self.__compare(expected, actual, "sorted", True)
+        # the usual case is a match, which == finds much faster than walking the values
+        if not self.__strict and values_equal(expected, actual):
+            return None
+        return self.__compare(expected, actual, "", False)
+
+    def __is_tolerant(self, nested):
+        return self.__rel_tol is not None and (self.__recursive or not nested)
+
+    def __compare(self, expected, actual, path, nested):
+        if self.__strict and type(expected) is not type(actual):
+            return Mismatch(path, f"expected type {type_name(expected)} but got type {type_name(actual)}")
+
+        if isinstance(expected, numbers.Number) and isinstance(actual, numbers.Number) \
+                and self.__is_tolerant(nested):
+            if isinstance(expected, numbers.Real) and isinstance(actual, numbers.Real):
+                close = math.isclose(actual, expected, rel_tol=self.__rel_tol, abs_tol=self.__abs_tol)
+            else:
+                close = values_equal(expected, actual)
+            return None if close else Mismatch(path, f"expected {expected!r} but got {actual!r}")
+        elif isinstance(expected, (list, tuple)):
+            return self.__compare_sequences(expected, actual, path)
+        elif isinstance(expected, dict):
+            return self.__compare_dicts(expected, actual, path)
+        elif isinstance(expected, (set, frozenset)):
+            return self.__compare_sets(expected, actual, path)
+        elif values_equal(expected, actual):
+            return None
+        return Mismatch(path, f"expected {short_repr(expected)} but got {short_repr(actual)}")
+
+    def __compare_sequences(self, expected, actual, path):
+        # like ==, a list never equals a tuple
+        if not isinstance(actual, (list, tuple)) or isinstance(actual, list) != isinstance(expected, list):
+            return Mismatch(path, f"expected a {type_name(expected)} but got {short_repr(actual)}")
+        if len(expected) != len(actual):
+            return Mismatch(path, f"expected {len(expected)} items but got {len(actual)}")
+        for i, (expected_item, actual_item) in enumerate(zip(expected, actual)):
+            # most items match, so check them as a whole before looking inside
+            if not self.__strict and values_equal(expected_item, actual_item):
+                continue
+            mismatch = self.__compare(expected_item, actual_item, f"{path}[{i}]", True)
+            if mismatch is not None:
+                return mismatch
+        return None
+
+    def __compare_dicts(self, expected, actual, path):
+        if not isinstance(actual, dict):
+            return Mismatch(path, f"expected a dict but got {short_repr(actual)}")
+        for key in expected:
+            if key not in actual:
+                return Mismatch(path, f"missing the key {short_repr(key)}")
+        for key in actual:
+            if key not in expected:
+                return Mismatch(path, f"has the key {short_repr(key)}, which it shouldn't")
+        for key, expected_value in expected.items():
+            if not self.__strict and values_equal(expected_value, actual[key]):
+                continue
+            mismatch = self.__compare(expected_value, actual[key], f"{path}[{key!r}]", True)
+            if mismatch is not None:
+                return mismatch
+        return None
+
+    def __compare_sets(self, expected, actual, path):
+        if not self.__set_like and not isinstance(actual, (set, frozenset)):
+            return Mismatch(path, f"expected a {type_name(expected)} but got {short_repr(actual)}")
+        try:
+            expected_items, actual_items = {x: x for x in expected}, {x: x for x in actual}
+        except TypeError:
+            # e.g. a list of lists, compared by fingerprint instead, which only a non-collection can't give
+            try:
+                expected_items = {fingerprint(x): x for x in expected}
+                actual_items = {fingerprint(x): x for x in actual}
+            except TypeError:
+                return Mismatch(path, f"expected a collection of values but got {short_repr(actual)}")
+        if self.__strict and not self.__set_like and type(expected) is not type(actual):
+            return Mismatch(path, f"expected type {type_name(expected)} but got type {type_name(actual)}")
+        missing = [expected_items[key] for key in expected_items.keys() - actual_items.keys()]
+        if missing:
+            return Mismatch(path, f"missing {short_repr(sort_items(missing)[0])}")
+        extra = [actual_items[key] for key in actual_items.keys() - expected_items.keys()]
+        if extra:
+            return Mismatch(path, f"has {short_repr(sort_items(extra)[0])}, which it shouldn't")
+        return None
+
+
+# what tests have always done: == everywhere, except a single number only has to be close
+DEFAULT_COMPARATOR = Comparator(DEFAULT_REL_TOL, recursive=False)
+EXACT_COMPARATOR = Comparator()
+
+
+def parse_comparator(lines):
+    """
+        A spec's *compare section, one option per line, e.g.
+        *compare
+        tolerance 1e-6
+        unordered
+        Options are exact, tolerance <relative> [<absolute>], unordered, set and strict
+    """
+    comparator = DEFAULT_COMPARATOR
+    for line in lines:
+        words = line.split()
+        if len(words) == 0:
+            continue
+        elif words[0] == "exact":
+            comparator = comparator.with_tolerance(None)
+        elif words[0] == "tolerance":
+            rel_tol = float(words[1]) if len(words) > 1 else DEFAULT_REL_TOL
+            abs_tol = float(words[2]) if len(words) > 2 else 0.0
+            comparator = comparator.with_tolerance(rel_tol, abs_tol)
+        elif words[0] == "unordered":
+            comparator = comparator.with_options(unordered=True)
+        elif words[0] == "set":
+            comparator = comparator.with_options(set_like=True)
+        elif words[0] == "strict":
+            comparator = comparator.with_options(strict=True)
+        else:
+            raise RuntimeError("Didn't recognise comparison")
+    return comparator
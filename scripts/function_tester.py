@@ -1,11 +1,38 @@
-from test_helper import Test, TestSpec
+from test_helper import Test, TestLimits, TimedOut, OutOfMemory, load_compiled_suite, run_tests_in_parallel, \
+    summarise_metrics, function_digest, spec_digest
+from sandbox import SandboxPool
+from reporters import TestRecord, TextReporter, FORMATS, TEXT, get_reporter, summarise_value, \
+    MAX_VALUE_LENGTH
+from spec_catalogue import resolve_spec
+import argparse
+import json
+import os
 import sys
 import textwrap
 
+# applied to any test whose spec doesn't set its own *limits, so an infinite loop can't hang the kernel
+DEFAULT_TIMEOUT = 10
+
+# FAIL_FAST stops at the first failing test (what students see), FULL runs everything and reports a score
+FAIL_FAST = "fail-fast"
+FULL = "full"
+
+# with %run -i this lives in the notebook's namespace, so it survives between runs of the cell
+HISTORY_NAME = "_function_tester_history"
+
+TRY_AGAIN = "Try editing your code and re-running the cell."
+SECRET_FAILED = "One or more secret tests failed. Make sure you are not being too specific in your code. " \
+                "The tests that failed will be similar to the previous tests shown here."
+
 
 def generic_hints(output):
     if output is None:
         return "Make sure you are always returning something from your function."
+    elif isinstance(output, TimedOut):
+        return "Your code didn't finish in time. Check that every loop will eventually stop, " \
+               "e.g. that a while loop's condition variable changes inside the loop."
+    elif isinstance(output, OutOfMemory):
+        return "Your code used too much memory. Check you aren't adding to a list or string forever."
     elif isinstance(output, IndexError):
         return "There was an IndexError. Check your indexing. " \
                "e.g. trying to access a character of an empty string will cause this error."
@@ -22,74 +49,287 @@ def format_var(var):
         return var
 
 
-def format_test_output(test):
-    output = "\n\tinputs: {}\n\texpected: {}" \
-             "\n\tactual: {}".format(str(test.get_inputs())[1:-1],
-                                     format_var(test.get_expected()),
-                                     format_var(test.get_output()))
+def get_test_hint(test):
+    """
+        The spec's hint for a failed test, or a generic one based on what went wrong
+    """
     if test.get_result():
-        # PASS
-        return output + "\n\tresult: PASS"
-    else:
-        # FAIL
-        if test.get_hint() != "":
-            hint = test.get_hint()
-        elif generic_hints(test.get_output()) != "":
-            hint = generic_hints(test.get_output())
-        else:
-            return output + "\n\tresult: FAIL"
+        return ""
+    elif test.get_hint() != "":
+        return test.get_hint()
+    return generic_hints(test.get_output())
+
+
+def format_value(value):
+    """
+        Big values (e.g. a 100x100 grid) are cut down, the difference line says where to look
+    """
+    text = str(format_var(value))
+    return text if len(text) <= MAX_VALUE_LENGTH else summarise_value(value)
 
-        hint = textwrap.indent(textwrap.fill(hint, 60), "\t" + " "*len("hint: ")).lstrip()
-        return output + "\n\tresult: FAIL\n\thint: " + hint
 
+def format_inputs(inputs):
+    text = str(inputs)[1:-1]
+    return text if len(text) <= MAX_VALUE_LENGTH else ", ".join(summarise_value(x) for x in inputs)
+
+
+def format_record(record):
+    output = "\n\tinputs: {}\n\texpected: {}" \
+             "\n\tactual: {}".format(format_inputs(record.inputs),
+                                     format_value(record.expected),
+                                     format_value(record.actual))
+    # for a wrong list or dict, where it first goes wrong
+    if record.mismatch is not None and isinstance(record.expected, (list, tuple, dict, set, frozenset)):
+        output += "\n\tdifference: {}".format(record.mismatch)
+    if record.metrics is not None:
+        output += "\n\tmetrics: {}".format(record.metrics)
+    # PASS, FAIL, TIMEOUT or OOM
+    output += "\n\tresult: " + record.outcome
+    if record.hint == "":
+        return output
 
-def run_tests(fn, tests, full_results=True):
-    successes = 0
+    hint = textwrap.indent(textwrap.fill(record.hint, 60), "\t" + " "*len("hint: ")).lstrip()
+    return output + "\n\thint: " + hint
+
+
+def format_test_output(test):
+    return format_record(TestRecord.from_test(None, None, False, test, get_test_hint(test)))
+
+
+def report_test(reporter, i, total, test, full_results):
+    # only secret tests are run without their full results
+    record = TestRecord.from_test(reporter.get_spec(), i + 1, not full_results, test, get_test_hint(test))
+    reporter.report(record, total, full_results)
+
+
+def evaluate_tests(fn, tests, workers=1, instrumented=False):
+    """
+        Runs every test, even after a failure, and returns the pass/fail of each in order
+        With more than one worker the tests run in parallel, so fn must be pure
+    """
+    if workers == 1:
+        return [test.run(fn, instrumented) for test in tests]
+    return run_tests_in_parallel(fn, tests, workers, instrumented)
+
+
+def run_tests(fn, tests, full_results=True, mode=FAIL_FAST, workers=1, instrumented=False, reporter=None,
+              replay=False, done=()):
+    """
+        With replay the results already recorded on the tests are reported without running anything
+        Tests in done have already been run with fn, so aren't run again
+    """
+    if reporter is None:
+        reporter = TextReporter(format_record)
     total = len(tests)
-    for i, test in enumerate(tests):
-        result = test.run(fn)
-        if full_results:
-            print(f"Test {i+1}/{total}: {format_test_output(test)}")
-        elif result:
-            print(f"Test {i+1}/{total}: PASS")
+    if mode == FULL:
+        if replay:
+            results = [test.get_result() for test in tests]
         else:
-            print(f"Test {i+1}/{total}: FAIL")
+            results = evaluate_tests(fn, tests, workers, instrumented)
+        for i, test in enumerate(tests):
+            report_test(reporter, i, total, test, full_results)
+        return all(results)
 
-        if result:
-            successes += 1
+    for i, test in enumerate(tests):
+        if replay or any(test is other for other in done):
+            result = test.get_result()
         else:
+            result = test.run(fn, instrumented)
+        report_test(reporter, i, total, test, full_results)
+        if not result:
             return False
     return True
 
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        raise RuntimeError("Need to provide test spec file as argument.")
-    if len(sys.argv) > 2:
-        # assume multiple arguments means spaces in the path
-        filename = " ".join(sys.argv[1:])
+def run_fail_fast(fn, tests, secret_tests, reporter, instrumented=False, replay=False, retry=None):
+    """
+        What students see: the visible tests up to the first failure, then the secret tests if they all passed
+        retry is (secret, index) of the test that failed last time. It's run first, and if it still fails
+        that's all that is reported, so a student working on one failing test gets an answer straight away
+    """
+    done = ()
+    if retry is not None:
+        secret, i = retry
+        test = (secret_tests if secret else tests)[i]
+        passed = test.get_result() if replay else test.run(fn, instrumented)
+        if not passed:
+            reporter.message("The test that failed last time still fails:\n")
+            if secret:
+                reporter.message(f"Running {len(secret_tests)} secret tests...\n")
+                report_test(reporter, i, len(secret_tests), test, False)
+                reporter.message("")
+                reporter.message(textwrap.fill(SECRET_FAILED))
+            else:
+                report_test(reporter, i, len(tests), test, True)
+                reporter.message("")
+                reporter.message(TRY_AGAIN)
+            return False
+        done = (test,)
+
+    success = run_tests(fn, tests, instrumented=instrumented, reporter=reporter, replay=replay, done=done)
+    reporter.message("")
+    if not success:
+        reporter.message(TRY_AGAIN)
+        return False
+
+    reporter.message(f"Running {len(secret_tests)} secret tests...\n")
+    success = run_tests(fn, secret_tests, False, instrumented=instrumented, reporter=reporter, replay=replay,
+                        done=done)
+    reporter.message("")
+    if success:
+        reporter.message("All tests passed! Great job!")
     else:
-        filename = sys.argv[1]
+        reporter.message(textwrap.fill(SECRET_FAILED))
+    return success
 
-    test_spec = TestSpec(filename)
 
-    tests, secret_tests = test_spec.generate_tests()
-    assert(test_spec.get_name() in dir())
-    test_fn = eval(test_spec.get_name())
+def get_first_failure(tests, secret_tests):
+    """
+        (secret, index) of the first test that was run and failed, or None
+    """
+    for secret, test_list in ((False, tests), (True, secret_tests)):
+        for i, test in enumerate(test_list):
+            if test.get_outcome() is not None and not test.get_result():
+                return secret, i
+    return None
 
-    print(f"Running tests on function {test_spec.get_name()}\n")
-    success = run_tests(test_fn, tests)
-    print()
 
-    if not success:
-        print("Try editing your code and re-running the cell.")
+def get_metrics_records(name, tests, secret_tests):
+    """
+        One dict per test that was run with instrumentation, then a summary for the whole spec
+    """
+    records = []
+    for secret, test_list in ((False, tests), (True, secret_tests)):
+        for i, test in enumerate(test_list):
+            if test.get_metrics() is not None:
+                record = {"spec": name, "index": i + 1, "secret": secret, "outcome": test.get_outcome()}
+                record.update(test.get_metrics().to_dict())
+                records.append(record)
+    records.append({"spec": name, "summary": summarise_metrics(tests + secret_tests)})
+    return records
+
+
+def write_json_lines(records, file):
+    for record in records:
+        file.write(json.dumps(record) + "\n")
+
+
+def format_metrics_summary(summary):
+    if summary["tests"] == 0:
+        return "No tests were instrumented."
+    return "Instrumented {} tests: {:.6f}s wall ({:.6f}s max), {:.6f}s CPU, peak {}B, " \
+           "{} calls ({} max), recursion depth {}".format(
+               summary["tests"], summary["total_wall_time"], summary["max_wall_time"], summary["total_cpu_time"],
+               summary["max_peak_memory"], summary["total_calls"], summary["max_calls"], summary["max_depth"])
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Test a function against a test spec.")
+    # multiple words are joined back together, since %run splits paths with spaces in them
+    parser.add_argument("spec", nargs="+", help="test spec file, or the name of one e.g. collatz")
+    parser.add_argument("--mode", choices=(FAIL_FAST, FULL), default=FAIL_FAST,
+                        help="stop at the first failure, or run every test and report a score")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="worker processes for --mode full (the function must be pure, not with --sandbox)")
+    parser.add_argument("--sandbox", action="store_true",
+                        help="run the spec's solution and the tested function in separate worker processes")
+    parser.add_argument("--instrument", action="store_true",
+                        help="record time, memory and (recursive) calls for each test")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="with --instrument, write the measurements as JSON lines ('-' for stdout)")
+    parser.add_argument("--format", choices=FORMATS, default=TEXT,
+                        help="text for people, or JSON lines / compressed columns for collecting results")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results here instead of stdout (JSON lines and columns are appended)")
+    parser.add_argument("--fresh", action="store_true",
+                        help="run every test, even if the function hasn't changed since the last run")
+    arguments = parser.parse_args(argv)
+    # sandboxed tests run in the sandbox's worker, which can't start a pool of its own
+    if arguments.sandbox and arguments.workers != 1:
+        parser.error("--sandbox runs tests one at a time, so can't be used with -j")
+    arguments.spec = " ".join(arguments.spec)
+    return arguments
+
+
+def grade(argv, namespace, load_suite=load_compiled_suite):
+    """
+        Tests the function named in the spec, looked up in namespace (the notebook's, when run with %run -i)
+        load_suite can be swapped for one that keeps suites in memory, see grading_magics
+    """
+    if len(argv) < 1:
+        raise RuntimeError("Need to provide test spec file as argument.")
+    arguments = parse_arguments(argv)
+    filename = resolve_spec(arguments.spec)
+
+    sandbox = SandboxPool(timeout=DEFAULT_TIMEOUT) if arguments.sandbox else None
+    suite = load_suite(filename, sandbox=sandbox)
+
+    tests, secret_tests = suite.get_tests(), suite.get_secret_tests()
+    if suite.get_name() not in namespace:
+        raise NameError(f"Couldn't find a function called {suite.get_name()}, make sure you've run its cell")
+    test_fn = namespace[suite.get_name()]
+
+    # the last run of this spec in this kernel: if the function is the same, so are the results
+    history = namespace.setdefault(HISTORY_NAME, {})
+    history_key = (os.path.realpath(filename), arguments.mode)
+    with open(filename, "rb") as spec_file:
+        spec = spec_digest(spec_file.read())
+    digest = function_digest(test_fn)
+    previous = history.get(history_key)
+    if arguments.fresh or arguments.instrument or previous is None or previous["spec"] != spec:
+        previous = None
+    replay = previous is not None and digest is not None and previous["function"] == digest
+    retry = None
+    if replay:
+        tests, secret_tests = previous["tests"], previous["secret_tests"]
+        retry = previous["retry"]
+    elif previous is not None and arguments.mode == FAIL_FAST:
+        retry = previous["failed"]
+
+    if sandbox is None and not replay:
+        # the sandbox enforces its own timeout in the worker
+        for test in tests + secret_tests:
+            test.add_default_limits(TestLimits(DEFAULT_TIMEOUT))
+    if sandbox is not None:
+        test_fn = sandbox.wrap(test_fn)
+
+    reporter = get_reporter(arguments.format, format_record, arguments.output)
+    reporter.start(suite.get_name())
+    reporter.message(f"Running tests on function {suite.get_name()}\n")
+    if replay:
+        reporter.message("Your function hasn't changed since the last run, so these are the same results.\n")
+    if arguments.mode == FULL:
+        run_tests(test_fn, tests, True, FULL, arguments.workers, arguments.instrument, reporter, replay)
+        reporter.message(f"\nRunning {len(secret_tests)} secret tests...\n")
+        run_tests(test_fn, secret_tests, False, FULL, arguments.workers, arguments.instrument, reporter, replay)
+        passed = sum(1 for test in tests + secret_tests if test.get_result())
+        reporter.message(f"\nScore: {passed}/{len(tests) + len(secret_tests)}")
     else:
-        print(f"Running {len(secret_tests)} secret tests...\n")
-        success = run_tests(test_fn, secret_tests, False)
-        print()
-        if success:
-            print("All tests passed! Great job!")
-        else:
-            print(textwrap.fill("One or more secret tests failed. Make sure you are not"
-                                " being too specific in your code. The tests that failed will"
-                                " be similar to the previous tests shown here."))
+        run_fail_fast(test_fn, tests, secret_tests, reporter, arguments.instrument, replay, retry)
+
+    if digest is not None:
+        history[history_key] = {"spec": spec, "function": digest, "tests": tests, "secret_tests": secret_tests,
+                                "retry": retry, "failed": get_first_failure(tests, secret_tests)}
+
+    summary = {"passed": sum(1 for test in tests + secret_tests if test.get_result()),
+               "run": sum(1 for test in tests + secret_tests if test.get_outcome() is not None),
+               "total": len(tests) + len(secret_tests)}
+    if arguments.instrument:
+        summary["metrics"] = summarise_metrics(tests + secret_tests)
+        reporter.message("\n" + format_metrics_summary(summary["metrics"]))
+    reporter.finish(summary)
+    reporter.close()
+
+    if arguments.instrument:
+        if arguments.metrics == "-":
+            write_json_lines(get_metrics_records(suite.get_name(), tests, secret_tests), sys.stdout)
+        elif arguments.metrics:
+            with open(arguments.metrics, "w") as metrics_file:
+                write_json_lines(get_metrics_records(suite.get_name(), tests, secret_tests), metrics_file)
+
+    if sandbox is not None:
+        sandbox.close()
+
+
+if __name__ == "__main__":
+    grade(sys.argv[1:], globals())
@@ -0,0 +1,338 @@
+from test_helper import TestLimits, load_compiled_suite
+from batch_grader import COLUMNS, DEFAULT_TIMEOUT, find_submissions, get_submission_code, get_student, new_result, \
+    grade_code, format_table, write_csv
+from spec_catalogue import SpecCatalogue, SPEC, resolve_spec
+from multiprocessing.connection import Listener, Client
+import argparse
+import multiprocessing
+import os
+import pickle
+import secrets
+import threading
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8766
+# how long the coordinator waits for one job before giving up on the worker running it
+DEFAULT_JOB_TIMEOUT = 600
+DEFAULT_RETRIES = 2
+KEY_VARIABLE = "GRADING_CLUSTER_KEY"
+CLUSTER_COLUMNS = ("spec",) + COLUMNS
+
+# messages, each a tuple starting with one of these
+# worker: (NEXT,) once connected, then (SUITE, spec) and (RESULT, job, result) or (FAILED, job, reason) for each job
+# coordinator: (JOB, job, spec, student, blocks, limits), (SUITE, spec, pickled suite) or (DONE,)
+NEXT = "next"
+JOB = "job"
+SUITE = "suite"
+RESULT = "result"
+FAILED = "failed"
+DONE = "done"
+
+
+class GradingJob:
+    """
+        One submission against one spec. The code is read by the coordinator, so workers don't need the files.
+    """
+    def __init__(self, index, spec, student, blocks):
+        self.__index = index
+        self.__spec = spec
+        self.__student = student
+        self.__blocks = blocks
+        self.__attempts = 0
+
+    def get_index(self):
+        return self.__index
+
+    def get_spec(self):
+        return self.__spec
+
+    def get_student(self):
+        return self.__student
+
+    def get_blocks(self):
+        return self.__blocks
+
+    def get_attempts(self):
+        return self.__attempts
+
+    def start_attempt(self):
+        self.__attempts += 1
+
+
+class Coordinator:
+    """
+        Hands out (submission, spec) jobs to whichever workers connect, and collects their results
+        Workers ask for each compiled suite the first time they need it. A job whose worker disconnects,
+        stops responding or fails to grade it is given to another worker, up to retries more times.
+    """
+    def __init__(self, specs, submissions, limits=None, address=(DEFAULT_HOST, DEFAULT_PORT), authkey=None,
+                 retries=DEFAULT_RETRIES, job_timeout=DEFAULT_JOB_TIMEOUT):
+        self.__limits = limits
+        self.__retries = retries
+        self.__job_timeout = job_timeout
+        self.__authkey = authkey if authkey is not None else secrets.token_bytes(16)
+
+        self.__suites = {}
+        self.__suite_data = {}
+        for spec in specs:
+            self.__suites[spec] = load_compiled_suite(spec)
+            self.__suite_data[spec] = pickle.dumps(self.__suites[spec])
+
+        self.__results = []
+        self.__pending = []
+        for filename in submissions:
+            try:
+                blocks = get_submission_code(filename)
+            except (OSError, ValueError, SyntaxError) as e:
+                for spec in specs:
+                    self.__add_result(spec, new_result(self.__suites[spec], get_student(filename),
+                                                       f"could not load: {e.__class__.__name__}"))
+                continue
+            for spec in specs:
+                self.__pending.append(GradingJob(len(self.__pending), spec, get_student(filename), blocks))
+        self.__pending.reverse()
+        self.__running = 0
+        self.__condition = threading.Condition()
+
+        self.__listener = Listener(address, authkey=self.__authkey)
+
+    def get_address(self):
+        return self.__listener.address
+
+    def get_authkey(self):
+        return self.__authkey
+
+    def get_results(self):
+        with self.__condition:
+            return sorted(self.__results, key=lambda result: (result["spec"], result["student"]))
+
+    def is_finished(self):
+        with self.__condition:
+            return len(self.__pending) == 0 and self.__running == 0
+
+    def wait(self, timeout=None):
+        with self.__condition:
+            return self.__condition.wait_for(lambda: len(self.__pending) == 0 and self.__running == 0, timeout)
+
+    def __add_result(self, spec, result):
+        result["spec"] = spec
+        self.__results.append(result)
+
+    def __take(self):
+        """
+            The next job, waiting while other workers' jobs might still be retried, or None when there are none
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: len(self.__pending) > 0 or self.__running == 0)
+            if len(self.__pending) == 0:
+                return None
+            job = self.__pending.pop()
+            job.start_attempt()
+            self.__running += 1
+            return job
+
+    def __finish(self, job, result):
+        with self.__condition:
+            self.__add_result(job.get_spec(), result)
+            self.__running -= 1
+            self.__condition.notify_all()
+
+    def __fail(self, job, reason):
+        with self.__condition:
+            if job.get_attempts() <= self.__retries:
+                # to the back of the queue, so it's likely to go to a different worker
+                self.__pending.insert(0, job)
+            else:
+                self.__add_result(job.get_spec(), new_result(self.__suites[job.get_spec()], job.get_student(),
+                                                             f"worker failed: {reason}"))
+            self.__running -= 1
+            self.__condition.notify_all()
+
+    def __receive(self, connection):
+        if not connection.poll(self.__job_timeout):
+            raise TimeoutError("timed out")
+        return connection.recv()
+
+    def __serve(self, connection):
+        job = None
+        try:
+            connection.recv()
+            while True:
+                job = self.__take()
+                if job is None:
+                    connection.send((DONE,))
+                    return
+                connection.send((JOB, job.get_index(), job.get_spec(), job.get_student(), job.get_blocks(),
+                                 self.__limits))
+                message = self.__receive(connection)
+                while message[0] == SUITE:
+                    connection.send((SUITE, message[1], self.__suite_data[message[1]]))
+                    message = self.__receive(connection)
+                if message[0] == RESULT:
+                    self.__finish(job, message[2])
+                else:
+                    self.__fail(job, message[2])
+                job = None
+        except TimeoutError:
+            if job is not None:
+                self.__fail(job, "timed out")
+        except (OSError, EOFError):
+            if job is not None:
+                self.__fail(job, "disconnected")
+        finally:
+            connection.close()
+
+    def __accept(self):
+        while True:
+            try:
+                connection = self.__listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                # closed, or a client that didn't know the key
+                if self.is_finished():
+                    return
+                continue
+            threading.Thread(target=self.__serve, args=(connection,), daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def close(self):
+        self.__listener.close()
+
+
+def run_worker(address, authkey):
+    """
+        Grades jobs from the coordinator at address until there are none left, returns how many it did
+    """
+    suites = {}
+    graded = 0
+    with Client(address, authkey=authkey) as connection:
+        connection.send((NEXT,))
+        while True:
+            message = connection.recv()
+            if message[0] == DONE:
+                return graded
+            _, index, spec, student, blocks, limits = message
+            if spec not in suites:
+                connection.send((SUITE, spec))
+                suites[spec] = pickle.loads(connection.recv()[2])
+            try:
+                connection.send((RESULT, index, grade_code(suites[spec], student, blocks, limits)))
+            except Exception as e:
+                connection.send((FAILED, index, f"{e.__class__.__name__}: {e}"))
+            graded += 1
+
+
+def _run_local_worker(address, authkey):
+    try:
+        run_worker(address, authkey)
+    except (OSError, EOFError):
+        pass
+
+
+def run_local(coordinator, workers):
+    """
+        Runs the whole cluster on this machine, with worker processes standing in for nodes
+        A worker that dies (e.g. a submission that crashed the interpreter) is replaced while there is work left
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    coordinator.start()
+    while True:
+        processes = [process for process in processes if process.is_alive()]
+        for _ in range(workers - len(processes) if not coordinator.is_finished() else 0):
+            process = context.Process(target=_run_local_worker,
+                                      args=(coordinator.get_address(), coordinator.get_authkey()), daemon=True)
+            process.start()
+            processes.append(process)
+        if coordinator.wait(0.5):
+            break
+    for process in processes:
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+    coordinator.close()
+    return coordinator.get_results()
+
+
+def find_chapter_specs(chapters, root):
+    catalogue = SpecCatalogue(root)
+    if catalogue.refresh() > 0:
+        catalogue.save()
+    paths = [path for path, entry in catalogue.get_entries().items()
+             if entry["kind"] == SPEC and entry["chapter"] in chapters]
+    return [os.path.join(catalogue.get_root(), path) for path in sorted(paths)]
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+
+def get_authkey(text):
+    key = text if text is not None else os.environ.get(KEY_VARIABLE)
+    return key.encode() if key is not None else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade submissions against many specs on many machines.")
+    subparsers = parser.add_subparsers(dest="role", required=True)
+
+    coordinator_parser = subparsers.add_parser("coordinator", help="hand out jobs and collect the results")
+    coordinator_parser.add_argument("submissions", help="directory of .py or .ipynb submissions")
+    coordinator_parser.add_argument("specs", nargs="*", help="test spec files or names, e.g. collatz")
+    coordinator_parser.add_argument("--chapter", type=int, action="append", default=[],
+                                    help="every spec in this chapter (can be given more than once)")
+    coordinator_parser.add_argument("--root", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    coordinator_parser.add_argument("--local", type=int, metavar="WORKERS", default=None,
+                                    help="start this many workers here instead of waiting for other machines")
+    coordinator_parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                                    help="times a job is given to another worker after its worker fails")
+    coordinator_parser.add_argument("--job-timeout", type=float, default=DEFAULT_JOB_TIMEOUT,
+                                    help="seconds a worker has to finish one job")
+    coordinator_parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                                    help="seconds allowed per test, unless the spec sets its own *limits")
+    coordinator_parser.add_argument("--memory", type=float, default=None,
+                                    help="megabytes allowed per test, unless the spec sets its own *limits")
+    coordinator_parser.add_argument("--csv", help="also write the results table to this file")
+
+    worker_parser = subparsers.add_parser("worker", help="grade jobs from a coordinator")
+
+    for role_parser in (coordinator_parser, worker_parser):
+        role_parser.add_argument("--address", default=f"{DEFAULT_HOST}:{DEFAULT_PORT}", help="host:port")
+        role_parser.add_argument("--authkey", default=None,
+                                 help=f"shared secret, or set {KEY_VARIABLE} (--local makes one up if neither)")
+    args = parser.parse_args()
+
+    if args.role == "worker":
+        try:
+            print(f"Graded {run_worker(parse_address(args.address), get_authkey(args.authkey))} jobs")
+        except (OSError, EOFError) as e:
+            # e.g. the coordinator gave up waiting for this worker, or was stopped
+            print(f"Lost the coordinator: {e.__class__.__name__}")
+    else:
+        if not os.path.isdir(args.submissions):
+            raise RuntimeError("Submissions must be a directory.")
+        specs = [resolve_spec(spec) for spec in args.specs] + find_chapter_specs(args.chapter, args.root)
+        if len(specs) == 0:
+            raise RuntimeError("Need at least one spec or --chapter.")
+        authkey = get_authkey(args.authkey)
+        if authkey is None and args.local is None:
+            raise RuntimeError(f"Workers on other machines need a shared --authkey or {KEY_VARIABLE}.")
+
+        address = (DEFAULT_HOST, 0) if args.local is not None else parse_address(args.address)
+        coordinator = Coordinator(specs, find_submissions(args.submissions), TestLimits(args.timeout, args.memory),
+                                  address, authkey, args.retries, args.job_timeout)
+        if args.local is not None:
+            results = run_local(coordinator, args.local)
+        else:
+            coordinator.start()
+            coordinator.wait()
+            coordinator.close()
+            results = coordinator.get_results()
+
+        for result in results:
+            result["spec"] = os.path.relpath(result["spec"], args.root)
+        print(format_table(results, CLUSTER_COLUMNS))
+        if args.csv:
+            write_csv(results, args.csv, CLUSTER_COLUMNS)
@@ -0,0 +1,74 @@
+"""
+    %grade and %examples for notebooks, keeping compiled suites in the kernel between clicks
+    Load once per kernel, from a cell in a Chapter directory:
+
+        import sys; sys.path.append("../scripts")
+        %load_ext grading_magics
+
+    then %grade ./questions/section/collatz, or %grade collatz, with the same options as function_tester.py
+"""
+from test_helper import CompiledSuite, load_compiled_suite
+from function_tester import grade
+from show_examples import show_examples
+import copy
+import os
+import shlex
+
+
+class SuiteStore:
+    """
+        Compiled suites by path, reloaded only when the spec file changes
+        Each load gets its own copies of the tests, so a run can't change the results kept from an earlier one
+    """
+    def __init__(self, load_suite=load_compiled_suite):
+        self.__load_suite = load_suite
+        self.__suites = {}
+
+    def clear(self):
+        self.__suites.clear()
+
+    def get_suite(self, filename, **kwargs):
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self.__suites.get(path)
+        # a sandbox means running the solution again, so the suite isn't kept
+        if cached is None or cached[0] != version or kwargs.get("sandbox") is not None:
+            suite = self.__load_suite(path, **kwargs)
+            cached = (version, suite)
+            if kwargs.get("sandbox") is None:
+                self.__suites[path] = cached
+        return cached[1]
+
+    def load_suite(self, filename, **kwargs):
+        """
+            A drop in for test_helper.load_compiled_suite
+        """
+        suite = self.get_suite(filename, **kwargs)
+        return CompiledSuite(suite.get_name(), [copy.copy(test) for test in suite.get_tests()],
+                             [copy.copy(test) for test in suite.get_secret_tests()])
+
+
+class GradingSession:
+    """
+        The magics for one kernel: the function is looked up in namespace, and so is the grading history,
+        so %grade and %run -i function_tester.py share it
+    """
+    def __init__(self, namespace, store=None):
+        self.__namespace = namespace
+        self.__store = store if store is not None else SuiteStore()
+
+    def get_store(self):
+        return self.__store
+
+    def grade(self, line):
+        grade(shlex.split(line), self.__namespace, self.__store.load_suite)
+
+    def examples(self, line):
+        show_examples(line.strip(), self.__store.load_suite)
+
+
+def load_ipython_extension(ipython):
+    session = GradingSession(ipython.user_ns)
+    ipython.register_magic_function(session.grade, "line", "grade")
+    ipython.register_magic_function(session.examples, "line", "examples")
@@ -1,7 +1,92 @@
+from random_streams import derive_rng, derive_seed
 import sys
 import random
-import copy
 import re
+import hashlib
+import json
+import math
+import os
+
+# pre-rendered questions live next to the question file, see build_question_pools.py
+POOL_DIR = "__questionpool__"
+POOL_VERSION = 1
+
+
+class RNGTemplate:
+    """
+        A question split once into literal text and placeholders, so it can be rendered in one pass
+        Placeholders are (format, binding) pairs, binding is None for an unbound placeholder like #rsn
+    """
+    def __init__(self, segments):
+        self.__segments = segments
+        # each format's distinct @n bindings, which all get different values
+        self.__bindings = {}
+        for segment in segments:
+            if not isinstance(segment, str) and segment[1] is not None:
+                bindings = self.__bindings.setdefault(segment[0], [])
+                if segment[1] not in bindings:
+                    bindings.append(segment[1])
+
+    def get_segments(self):
+        return self.__segments
+
+    def get_bindings(self):
+        return self.__bindings
+
+    def count(self):
+        """
+            How many different ways the placeholders can be filled in
+            Each format's @n bindings take different values, so they're a permutation of its values
+        """
+        total = 1
+        for random_format, bindings in self.__bindings.items():
+            total *= math.perm(len(RNGFormat.random_formats[random_format]), len(bindings))
+        for segment in self.__segments:
+            if not isinstance(segment, str) and segment[1] is None:
+                total *= len(RNGFormat.random_formats[segment[0]])
+        return total
+
+    def render_index(self, index):
+        """
+            The index-th of the count() ways of filling in the placeholders, each index a different one
+            index is read as a mixed radix number, one digit per choice (with one fewer value left
+            for each @n binding of a format after the first)
+        """
+        values = {}
+        for random_format, bindings in self.__bindings.items():
+            remaining = list(RNGFormat.random_formats[random_format])
+            for binding in bindings:
+                index, digit = divmod(index, len(remaining))
+                values[random_format, binding] = remaining.pop(digit)
+
+        parts = []
+        for segment in self.__segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            elif segment[1] is None:
+                choices = RNGFormat.random_formats[segment[0]]
+                index, digit = divmod(index, len(choices))
+                parts.append(str(choices[digit]))
+            else:
+                parts.append(str(values[segment]))
+        return "".join(parts)
+
+    def render(self, rng=random):
+        values = {}
+        for random_format, bindings in self.__bindings.items():
+            choices = rng.sample(RNGFormat.random_formats[random_format], len(bindings))
+            for binding, value in zip(bindings, choices):
+                values[random_format, binding] = value
+
+        parts = []
+        for segment in self.__segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            elif segment[1] is None:
+                parts.append(str(rng.choice(RNGFormat.random_formats[segment[0]])))
+            else:
+                parts.append(str(values[segment]))
+        return "".join(parts)
 
 
 class RNGFormat:
@@ -18,31 +103,32 @@ class RNGFormat:
                       "#rss": ['"toad "', '"bird "', '"duck "']  # random string with space
                      }
 
+    # longest first, so that #rss doesn't match the start of #rssn
+    __pattern = re.compile("(" + "|".join(re.escape(random_format) for random_format
+                                          in sorted(random_formats, key=len, reverse=True)) + r")(?:@(\d+))?")
+    __templates = {}
+
     @staticmethod
-    def __get_random_thing(random_format):
-        return random.choice(RNGFormat.random_formats[random_format])
+    def compile(question):
+        template = RNGFormat.__templates.get(question)
+        if template is None:
+            segments = []
+            position = 0
+            for match in RNGFormat.__pattern.finditer(question):
+                if match.start() > position:
+                    segments.append(question[position:match.start()])
+                binding = int(match.group(2)) if match.group(2) is not None else None
+                segments.append((match.group(1), binding))
+                position = match.end()
+            if position < len(question):
+                segments.append(question[position:])
+            template = RNGTemplate(segments)
+            RNGFormat.__templates[question] = template
+        return template
 
     @staticmethod
-    def format(question):
-        if "@" in question:
-            rf_copy = copy.deepcopy(RNGFormat.random_formats)
-            i = 1
-            while "@" in question:
-                for random_format in RNGFormat.random_formats.keys():
-                    if random_format + "@{}".format(i) in question:
-                        random_thing = RNGFormat.__get_random_thing(random_format)
-                        question = question.replace(random_format + "@{}".format(i),
-                                                    str(random_thing))
-                        RNGFormat.random_formats[random_format].remove(random_thing)
-                i += 1
-            RNGFormat.random_formats = rf_copy
-
-        for random_format in RNGFormat.random_formats.keys():
-            while random_format in question:
-                question = question.replace(random_format,
-                                            str(RNGFormat.__get_random_thing(random_format)),
-                                            1)
-        return question
+    def format(question, rng=random):
+        return RNGFormat.compile(question).render(rng)
 
 
 class Question:
@@ -114,11 +200,24 @@ class BVQuestion(Question):
         return super().get_hint(guess)
 
 
+def question_to_entry(question):
+    kind = "BV" if isinstance(question, BVQuestion) else "Q"
+    return [question.get_question(), question.get_solution(), kind]
+
+
+def question_from_entry(entry):
+    question, answer, kind = entry
+    if kind == "BV":
+        return BVQuestion(question, answer)
+    return Question(question, answer)
+
+
 class QuestionFormat:
     def __init__(self, level=1, repeats=1):
         self.__level = level
         self.__repeats = repeats
         self.__question = ""
+        self.__pool = None
 
     def set_question(self, question):
         self.__question = question
@@ -132,9 +231,43 @@ class QuestionFormat:
     def get_question(self):
         return self.__question
 
-    def generate_question(self):
+    def get_key(self):
+        """
+            Identifies the format by its content, for its own random stream when a quiz is seeded
+        """
+        return self.__class__.__name__, self.__level, self.__question
+
+    def get_template(self):
+        return RNGFormat.compile(self.__question)
+
+    def build_question(self, formatted_question):
         raise NotImplementedError("This method is abstract.")
 
+    def generate_question(self, rng=random):
+        return self.build_question(RNGFormat.format(self.__question, rng))
+
+    def set_pool(self, pool):
+        self.__pool = pool
+
+    def get_pool(self):
+        return self.__pool
+
+    def count_questions(self):
+        """
+            How many different questions this format can give: its pool's, or every way of filling in its template
+        """
+        if self.__pool:
+            return len(self.__pool)
+        return self.get_template().count()
+
+    def question_at(self, index):
+        """
+            One of the count_questions() questions, see get_questions
+        """
+        if self.__pool:
+            return question_from_entry(self.__pool[index])
+        return self.build_question(self.get_template().render_index(index))
+
 
 def out_str(s):
     if isinstance(s, str):
@@ -143,13 +276,30 @@ def out_str(s):
         return str(s)
 
 
+def run_question_code(exec_code, eval_code):
+    """
+        Runs exec_code, then returns the value of eval_code the way it should be typed as an answer
+    """
+    namespace = {}
+    exec(exec_code, namespace)
+    return out_str(eval(eval_code, namespace))
+
+
+# swapped out by set_question_code_runner, e.g. to run question code in a sandbox.SandboxPool
+_question_code_runner = run_question_code
+
+
+def set_question_code_runner(runner):
+    global _question_code_runner
+    _question_code_runner = runner if runner is not None else run_question_code
+
+
 class QEFormat(QuestionFormat):
     def add_question(self, question):
         super().set_question(question)
 
-    def generate_question(self):
-        formatted_question = RNGFormat.format(self.get_question())
-        answer = out_str(eval(formatted_question))
+    def build_question(self, formatted_question):
+        answer = _question_code_runner("", formatted_question)
         return Question("What is the result of this expression?"
                         "\n{}".format(formatted_question),
                         answer)
@@ -162,13 +312,11 @@ class QSEFormat(QuestionFormat):
         else:
             super().set_question(self.get_question() + "\n" + question)
 
-    def generate_question(self):
-        formatted_question = RNGFormat.format(self.get_question())
+    def build_question(self, formatted_question):
         index = formatted_question.rindex("\n")
         formatted_exec = formatted_question[:index]
-        exec(formatted_exec)
         formatted_eval = formatted_question[index+1:]
-        answer = out_str(eval(formatted_eval))
+        answer = _question_code_runner(formatted_exec, formatted_eval)
         return Question("After the following code is executed:\n"
                         "{}\n"
                         "What is the result of the expression below?\n"
@@ -183,16 +331,14 @@ class BVFormat(QuestionFormat):
         else:
             super().set_question(self.get_question() + "\n" + question)
 
-    def generate_question(self):
-        formatted_question = RNGFormat.format(self.get_question())
+    def build_question(self, formatted_question):
         last_new_line_index = formatted_question.rindex("\n")
         formatted_exec = formatted_question[:last_new_line_index]
         formatted_eval = formatted_question[last_new_line_index + 1:]
 
         code_to_exec = formatted_exec.replace("$", "")
         code_to_eval = formatted_eval.replace("$", "")
-        exec(code_to_exec)
-        eval_answer = out_str(eval(code_to_eval))
+        eval_answer = _question_code_runner(code_to_exec, code_to_eval)
 
         dollar_index = formatted_question.index("$")
         re_match = re.search(r'[\s:]', formatted_question[dollar_index:])
@@ -211,13 +357,14 @@ class BVFormat(QuestionFormat):
 
 
 class FormatDeck:
-    def __init__(self, formats):
+    def __init__(self, formats, rng=random):
         self.__formats = formats
+        self.__rng = rng
         self.__renew()
 
     def __renew(self):
-        self.__deck = copy.deepcopy(self.__formats)
-        random.shuffle(self.__deck)
+        self.__deck = list(self.__formats)
+        self.__rng.shuffle(self.__deck)
 
     def draw(self):
         if len(self.__deck) == 0:
@@ -225,6 +372,28 @@ class FormatDeck:
         return self.__deck.pop()
 
 
+class IndexSampler:
+    """
+        Draws each of range(count) once, in a random order, without making a list of them all:
+        a Fisher-Yates shuffle that only remembers the positions it has swapped
+    """
+    def __init__(self, count, rng=random):
+        self.__remaining = count
+        self.__swapped = {}
+        self.__rng = rng
+
+    def get_remaining(self):
+        return self.__remaining
+
+    def draw(self):
+        position = self.__rng.randrange(self.__remaining)
+        last = self.__remaining - 1
+        value = self.__swapped.get(position, position)
+        self.__swapped[position] = self.__swapped.pop(last, last)
+        self.__remaining -= 1
+        return value
+
+
 def extract_parameter(line, option):
     line = line.strip()
     index_start = line.index(option) + len(option)
@@ -276,7 +445,7 @@ def get_question_formats(lines):
     return question_format_bag
 
 
-def get_tiered_questions(formats):
+def get_tiered_questions(formats, seed=None):
     formats.sort(key=lambda qf: qf.get_level())
     max_level = max(formats, key=lambda qf: qf.get_level()).get_level()
 
@@ -285,28 +454,66 @@ def get_tiered_questions(formats):
         level_formats = list(filter(lambda qf: qf.get_level() == level, formats))
 
         repeats = level_formats[0].get_repeats()
-        level_questions = get_questions(level_formats, repeats)
+        level_questions = get_questions(level_formats, repeats, seed)
         questions.extend(level_questions)
 
     return questions
 
 
-def get_questions(formats, number=10):
+def get_format_streams(formats, seed=None):
+    """
+        (random stream for the deck, random stream for each format)
+        Without a seed everything shares the global random, otherwise each gets its own derived stream
+    """
+    if seed is None:
+        return random, {question_format: random for question_format in formats}
+    deck_rng = derive_rng(seed, "deck", [question_format.get_key() for question_format in formats])
+    return deck_rng, {question_format: derive_rng(seed, *question_format.get_key()) for question_format in formats}
+
+
+def get_questions(formats, number=10, seed=None):
+    """
+        Each format's questions are drawn without replacement, so there are no duplicates unless the formats
+        can't make number different questions between them (see check_question_space), when they start over
+    """
     questions = []
-    deck = FormatDeck(formats)
-    for _ in range(number):
+    seen = set()
+    deck_rng, streams = get_format_streams(formats, seed)
+    deck = FormatDeck(formats, deck_rng)
+    samplers = {}
+    while len(questions) < number:
+        if all(sampler.get_remaining() == 0 for sampler in samplers.values()):
+            samplers = {question_format: IndexSampler(question_format.count_questions(), streams[question_format])
+                        for question_format in formats}
+            seen = set()
+            if all(sampler.get_remaining() == 0 for sampler in samplers.values()):
+                break
         question_format = deck.draw()
-        random_question = question_format.generate_question()
+        sampler = samplers[question_format]
+        if sampler.get_remaining() == 0:
+            continue
+        question = question_format.question_at(sampler.draw())
+        # a BV blank can hide the only difference between two questions
+        if question not in seen:
+            seen.add(question)
+            questions.append(question)
 
-        i = 0
-        while random_question in questions and i < 5:
-            question_format = deck.draw()
-            random_question = question_format.generate_question()
-            i += 1
+    return questions
 
-        questions.append(random_question)
 
-    return questions
+def check_question_space(formats):
+    """
+        A message for each level whose -r asks for more questions than its formats can make between them
+    """
+    messages = []
+    for level in sorted({question_format.get_level() for question_format in formats}):
+        level_formats = [question_format for question_format in formats if question_format.get_level() == level]
+        repeats = level_formats[0].get_repeats()
+        space = sum(question_format.count_questions() for question_format in level_formats)
+        if repeats > space:
+            messages.append(f"Level {level} asks for {repeats} questions (-r {repeats}) "
+                            f"but its formats can only make {space} different ones")
+    return messages
 
 
 def load_formats_from_file(filename):
@@ -315,65 +522,204 @@ def load_formats_from_file(filename):
     return get_question_formats(lines)
 
 
-def run(file):
-    question_formats = load_formats_from_file(file)
-    questions = get_tiered_questions(question_formats)
-
-    while True:
-        for question_number, question in enumerate(questions):
-            print("Question {} of {}".format(question_number+1, len(questions)))
-            unsolved = True
-            attempt = 1
-            while unsolved:
-                print(question.get_question())
-
-                guess = input(">>>")
-                guess = guess.strip()
-                if question.is_correct_answer(guess):
-                    print("Correct!\n")
-                    unsolved = False
-                elif guess == "quit":
-                    return
-                elif attempt >= 4 and guess == "I give up":
-                    print("The solution is:")
-                    print("\t" + question.get_solution())
-                    print("Work out why this is the case before continuing!")
-                    print("Please type 'I understand' (without quotes) to continue.")
-                    busywork = input(">>>")
-                    while busywork != "I understand":
-                        busywork = input(">>>")
-                    unsolved = False
-                elif question.get_hint(guess) != "":
-                    print(question.get_hint(guess) + "\n")
-                else:
-                    print("Try again...\n")
-
-                attempt += 1
-                if attempt >= 4 and unsolved:
-                    print("** Type 'I give up' (without quotes) to see the solution **")
-
-        print("All questions answered correctly! Great job.")
-        response = ""
-        while response.lower() not in ["yes", "no", "y", "n"]:
-            print("Would you like to try more questions like these? (Y/N)")
-            response = input(">>>")
-
-        if response.lower() in ["yes", "y"]:
-            questions = get_questions(question_formats)
+def get_pool_filename(filename):
+    directory, base = os.path.split(filename)
+    return os.path.join(directory, POOL_DIR, base + ".json")
+
+
+def question_file_digest(filename):
+    with open(filename, "rb") as text_file:
+        digest = hashlib.sha256(text_file.read())
+    digest.update(f"version={POOL_VERSION}".encode())
+    return digest.hexdigest()
+
+
+def build_pools(formats, size=50, seed=None):
+    """
+        Renders up to size different questions for each format, or every one it can make if that's fewer
+    """
+    _, streams = get_format_streams(formats, seed)
+    pools = []
+    for question_format in formats:
+        template = question_format.get_template()
+        sampler = IndexSampler(template.count(), streams[question_format])
+        questions = {}
+        while len(questions) < size and sampler.get_remaining() > 0:
+            question = question_format.build_question(template.render_index(sampler.draw()))
+            questions.setdefault(question.get_question(), question)
+        pools.append([question_to_entry(question) for question in questions.values()])
+    return pools
+
+
+def save_pools(filename, pools):
+    pool_filename = get_pool_filename(filename)
+    os.makedirs(os.path.dirname(pool_filename), exist_ok=True)
+    with open(pool_filename, "w") as pool_file:
+        json.dump({"digest": question_file_digest(filename), "formats": pools}, pool_file)
+
+
+def load_pools(filename, formats):
+    """
+        Attaches the saved pools to formats, returns False if there weren't any up to date pools
+    """
+    try:
+        with open(get_pool_filename(filename), "r") as pool_file:
+            saved = json.load(pool_file)
+    except (OSError, ValueError):
+        return False
+    if saved.get("digest") != question_file_digest(filename) or len(saved["formats"]) != len(formats):
+        return False
+    for question_format, pool in zip(formats, saved["formats"]):
+        question_format.set_pool(pool)
+    return True
+
+
+class QuizSession:
+    """
+        The state of one student's quiz, driven one line of input at a time
+        start() and respond() return the text to show before the next ">>>" prompt
+    """
+    ASKING = 0
+    UNDERSTANDING = 1
+    AGAIN = 2
+    FINISHED = 3
+
+    __slots__ = ("__formats", "__questions", "__index", "__attempt", "__state", "__output", "__seed", "__round")
+
+    def __init__(self, formats, questions=None, seed=None):
+        """
+            The same seed always gives the same questions, None gives a different quiz each time
+        """
+        self.__formats = formats
+        self.__seed = seed
+        self.__round = 0
+        self.__questions = questions if questions is not None else get_tiered_questions(formats, seed)
+        self.__index = 0
+        self.__attempt = 1
+        self.__state = QuizSession.ASKING
+        self.__output = []
+
+    def is_finished(self):
+        return self.__state == QuizSession.FINISHED
+
+    def get_question_number(self):
+        return self.__index + 1
+
+    def get_attempt(self):
+        return self.__attempt
+
+    def __print(self, text=""):
+        self.__output.append(text + "\n")
+
+    def __flush(self):
+        text = "".join(self.__output)
+        self.__output = []
+        return text
+
+    def __begin_question(self):
+        if self.__index >= len(self.__questions):
+            self.__print("All questions answered correctly! Great job.")
+            self.__print("Would you like to try more questions like these? (Y/N)")
+            self.__state = QuizSession.AGAIN
+            return
+        self.__state = QuizSession.ASKING
+        self.__attempt = 1
+        self.__print("Question {} of {}".format(self.__index + 1, len(self.__questions)))
+        self.__print(self.__questions[self.__index].get_question())
+
+    def __next_question(self):
+        self.__index += 1
+        self.__begin_question()
+
+    def start(self):
+        self.__begin_question()
+        return self.__flush()
+
+    def respond(self, line):
+        if self.__state == QuizSession.ASKING:
+            self.__answer(line.strip())
+        elif self.__state == QuizSession.UNDERSTANDING:
+            if line == "I understand":
+                self.__next_question()
+        elif self.__state == QuizSession.AGAIN:
+            if line.lower() in ["yes", "y"]:
+                self.__round += 1
+                seed = derive_seed(self.__seed, "again", self.__round) if self.__seed is not None else None
+                self.__questions = get_questions(self.__formats, seed=seed)
+                self.__index = 0
+                self.__begin_question()
+            elif line.lower() in ["no", "n"]:
+                self.__state = QuizSession.FINISHED
+            else:
+                self.__print("Would you like to try more questions like these? (Y/N)")
+        return self.__flush()
+
+    def __answer(self, guess):
+        question = self.__questions[self.__index]
+        if question.is_correct_answer(guess):
+            self.__print("Correct!\n")
+            self.__next_question()
+            return
+        elif guess == "quit":
+            self.__state = QuizSession.FINISHED
+            return
+        elif self.__attempt >= 4 and guess == "I give up":
+            self.__print("The solution is:")
+            self.__print("\t" + question.get_solution())
+            self.__print("Work out why this is the case before continuing!")
+            self.__print("Please type 'I understand' (without quotes) to continue.")
+            self.__state = QuizSession.UNDERSTANDING
+            return
+        elif question.get_hint(guess) != "":
+            self.__print(question.get_hint(guess) + "\n")
         else:
-            break
+            self.__print("Try again...\n")
+
+        self.__attempt += 1
+        if self.__attempt >= 4:
+            self.__print("** Type 'I give up' (without quotes) to see the solution **")
+        self.__print(question.get_question())
+
+
+def run(file, seed=None):
+    question_formats = load_formats_from_file(file)
+    load_pools(file, question_formats)
+    session = QuizSession(question_formats, seed=seed)
+
+    print(session.start(), end="")
+    while not session.is_finished():
+        print(session.respond(input(">>>")), end="")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    arguments = sys.argv[1:]
+    sandbox = None
+    if "--sandbox" in arguments:
+        # run the question code in a separate process
+        from sandbox import SandboxPool
+        arguments.remove("--sandbox")
+        sandbox = SandboxPool()
+        set_question_code_runner(sandbox.run_question_code)
+
+    seed = None
+    if "--seed" in arguments:
+        # the same seed gives the same quiz, e.g. to reproduce a problem a student reported
+        position = arguments.index("--seed")
+        seed = int(arguments[position + 1])
+        del arguments[position:position + 2]
+
+    if len(arguments) < 1:
         raise RuntimeError("Need to provide question file as argument.")
-    if len(sys.argv) > 2:
+    if len(arguments) > 1:
         # assume multiple arguments means spaces in the path
-        filename = " ".join(sys.argv[1:])
+        filename = " ".join(arguments)
     else:
-        filename = sys.argv[1]
+        filename = arguments[0]
 
     try:
-        run(filename)
+        run(filename, seed)
     except KeyboardInterrupt:
         pass
+    finally:
+        if sandbox is not None:
+            sandbox.close()
@@ -0,0 +1,124 @@
+from interactive_questions import QuizSession, load_formats_from_file, load_pools, set_question_code_runner
+from random_streams import derive_seed
+from spec_catalogue import SpecCatalogue, QUESTIONS
+from sandbox import SandboxPool
+import argparse
+import asyncio
+import os
+import sys
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+PROMPT = b">>>"
+
+
+class QuizServer:
+    """
+        Serves quizzes to many students from one process
+        A client sends the path of a question file (relative to root), or its name e.g. 2.2.1, as its first line,
+        then gets exactly what interactive_questions.run would print, with a ">>>" before each answer
+    """
+    def __init__(self, root=".", seed=None):
+        self.__root = os.path.realpath(root)
+        # question files are only parsed once, however many sessions use them
+        self.__formats = {}
+        self.__sessions = 0
+        self.__catalogue = SpecCatalogue(self.__root)
+        # with a seed, the nth session to start always gets the same quiz
+        self.__seed = seed
+        self.__started = 0
+
+    def get_session_count(self):
+        return self.__sessions
+
+    def get_formats(self, filename):
+        path = os.path.realpath(os.path.join(self.__root, filename))
+        if not os.path.isfile(path):
+            paths = self.__catalogue.find(filename, QUESTIONS)
+            if len(paths) == 1:
+                path = os.path.realpath(os.path.join(self.__root, paths[0]))
+        if os.path.commonpath([self.__root, path]) != self.__root or not os.path.isfile(path):
+            raise FileNotFoundError(f"No question file {filename}")
+        if path not in self.__formats:
+            formats = load_formats_from_file(path)
+            load_pools(path, formats)
+            self.__formats[path] = formats
+        return self.__formats[path]
+
+    async def handle(self, reader, writer):
+        self.__sessions += 1
+        self.__started += 1
+        seed = derive_seed(self.__seed, self.__started) if self.__seed is not None else None
+        try:
+            filename = (await reader.readline()).decode().strip()
+            try:
+                session = QuizSession(self.get_formats(filename), seed=seed)
+            except (OSError, ValueError) as e:
+                writer.write(f"{e}\n".encode())
+                return
+
+            writer.write(session.start().encode() + PROMPT)
+            await writer.drain()
+            while not session.is_finished():
+                line = await reader.readline()
+                if line == b"":
+                    break
+                output = session.respond(line.decode().rstrip("\r\n"))
+                writer.write(output.encode())
+                if not session.is_finished():
+                    writer.write(PROMPT)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.__sessions -= 1
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+async def run_client(filename, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+        A terminal client, so the server can be tried out without a web front end
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(filename.encode() + b"\n")
+    await writer.drain()
+
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            output = await reader.readuntil(PROMPT)
+        except asyncio.IncompleteReadError as e:
+            # the server closes the connection when the quiz is over
+            print(e.partial.decode(), end="")
+            break
+        guess = await loop.run_in_executor(None, input, output.decode())
+        writer.write(guess.encode() + b"\n")
+        await writer.drain()
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve quizzes to many students at once.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--root", default=".", help="question files are looked up relative to this directory")
+    parser.add_argument("--client", metavar="QUESTION_FILE", help="connect to a running server instead")
+    parser.add_argument("--sandbox", action="store_true", help="run question code in separate worker processes")
+    parser.add_argument("--seed", type=int, default=None, help="make the quizzes reproducible")
+    args = parser.parse_args()
+
+    try:
+        if args.client:
+            asyncio.run(run_client(args.client, args.host, args.port))
+        else:
+            if args.sandbox:
+                set_question_code_runner(SandboxPool().run_question_code)
+            print(f"Serving quizzes from {os.path.realpath(args.root)} on {args.host}:{args.port}", file=sys.stderr)
+            asyncio.run(QuizServer(args.root, args.seed).serve(args.host, args.port))
+    except (KeyboardInterrupt, EOFError):
+        pass
@@ -0,0 +1,18 @@
+import hashlib
+import random
+
+
+def derive_seed(seed, *key):
+    """
+        A 64 bit seed that depends only on seed and key (e.g. a spec name and line), never on
+        what else has been generated, in this process or any other
+    """
+    digest = hashlib.sha256(repr((seed,) + key).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def derive_rng(seed, *key):
+    """
+        An independent random.Random for one part of a spec or question file
+    """
+    return random.Random(derive_seed(seed, *key))
@@ -0,0 +1,217 @@
+import json
+import marshal
+import reprlib
+import struct
+import sys
+import zlib
+
+TEXT = "text"
+JSON_LINES = "jsonl"
+COLUMNAR = "columnar"
+FORMATS = (TEXT, JSON_LINES, COLUMNAR)
+
+# each columnar frame is this header, the length of the data, then the zlib compressed JSON of the columns
+COLUMNAR_MAGIC = b"FTR2"
+# frames from before, compressed marshal, which only the Python version that wrote them is sure to read
+MARSHAL_COLUMNAR_MAGIC = b"FTR1"
+COLUMNAR_HEADER = struct.Struct(">4sI")
+FIELDS = ("spec", "index", "secret", "inputs", "expected", "actual", "outcome", "hint", "time", "mismatch")
+METRIC_FIELDS = ("wall_time", "cpu_time", "peak_memory", "calls", "max_depth")
+
+# e.g. a 100x100 grid comes out as [[12, 7, 33, 2, 9, 41, ...], [...], ...]
+_value_repr = reprlib.Repr()
+_value_repr.maxlevel = 3
+_value_repr.maxlist = 6
+_value_repr.maxtuple = 6
+_value_repr.maxdict = 6
+_value_repr.maxset = 6
+_value_repr.maxstring = 80
+_value_repr.maxother = 200
+MAX_VALUE_LENGTH = 400
+
+
+def summarise_value(value):
+    """
+        A short repr of value, with long containers and strings cut down
+    """
+    text = _value_repr.repr(value)
+    if len(text) > MAX_VALUE_LENGTH:
+        text = text[:MAX_VALUE_LENGTH - 3] + "..."
+    return text
+
+
+class TestRecord:
+    """
+        Everything about one run of one test, in a form that can be written out
+        inputs, expected and actual are kept as the real values; reporters decide how to show them
+    """
+    def __init__(self, spec, index, secret, inputs, expected, actual, outcome, hint="", time=None, metrics=None,
+                 mismatch=None):
+        self.spec = spec
+        self.index = index
+        self.secret = secret
+        self.inputs = inputs
+        self.expected = expected
+        self.actual = actual
+        self.outcome = outcome
+        self.hint = hint
+        self.time = time
+        self.metrics = metrics
+        # e.g. "at [37][12]: expected 5 but got 6", for a wrong output
+        self.mismatch = mismatch
+
+    @staticmethod
+    def from_test(spec, index, secret, test, hint=""):
+        mismatch = str(test.get_mismatch()) if test.get_mismatch() is not None else None
+        return TestRecord(spec, index, secret, test.get_inputs(), test.get_expected(), test.get_output(),
+                          test.get_outcome(), hint, test.get_elapsed(), test.get_metrics(), mismatch)
+
+    def to_dict(self):
+        """
+            Only plain values, with inputs and outputs summarised, so it can go straight to JSON
+        """
+        record = {"spec": self.spec, "index": self.index, "secret": self.secret,
+                  "inputs": summarise_value(self.inputs), "expected": summarise_value(self.expected),
+                  "actual": summarise_value(self.actual), "outcome": self.outcome, "hint": self.hint,
+                  "time": self.time, "mismatch": self.mismatch}
+        if self.metrics is not None:
+            record.update(self.metrics.to_dict())
+        return record
+
+
+class Reporter:
+    """
+        Receives every test as it finishes. Subclasses override the methods they need.
+        message is for the prose around the tests ("Running 3 secret tests...") which only text shows
+    """
+    def __init__(self, file=None):
+        self.__file = file
+        self.__spec = None
+
+    def get_file(self):
+        return self.__file if self.__file is not None else sys.stdout
+
+    def get_spec(self):
+        return self.__spec
+
+    def start(self, spec):
+        self.__spec = spec
+
+    def message(self, text):
+        pass
+
+    def report(self, record, total, full_results=True):
+        pass
+
+    def finish(self, summary):
+        """
+            summary is a dict of totals for the whole spec, e.g. passed and total
+        """
+        pass
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+
+
+class TextReporter(Reporter):
+    """
+        What students see in the notebook: each test's details, or just the outcome for secret tests
+    """
+    def __init__(self, formatter, file=None):
+        super().__init__(file)
+        self.__formatter = formatter
+
+    def message(self, text):
+        print(text, file=self.get_file())
+
+    def report(self, record, total, full_results=True):
+        if full_results:
+            print(f"Test {record.index}/{total}: {self.__formatter(record)}", file=self.get_file())
+        else:
+            print(f"Test {record.index}/{total}: {record.outcome}", file=self.get_file())
+
+
+class JsonLinesReporter(Reporter):
+    """
+        One JSON object per test, then one with "summary" for the spec
+    """
+    def report(self, record, total, full_results=True):
+        self.get_file().write(json.dumps(record.to_dict()) + "\n")
+
+    def finish(self, summary):
+        self.get_file().write(json.dumps({"spec": self.get_spec(), "summary": summary}) + "\n")
+        self.get_file().flush()
+
+
+class ColumnarReporter(Reporter):
+    """
+        Collects the records into one list per field and writes them as a single compressed frame
+        when the spec finishes. Frames can be appended to the same file, e.g. one per student.
+    """
+    def __init__(self, file=None):
+        super().__init__(file)
+        self.__columns = None
+
+    def start(self, spec):
+        super().start(spec)
+        self.__columns = {field: [] for field in FIELDS + METRIC_FIELDS}
+
+    def report(self, record, total, full_results=True):
+        values = record.to_dict()
+        for field, column in self.__columns.items():
+            column.append(values.get(field))
+
+    def finish(self, summary):
+        frame = {"spec": self.get_spec(), "summary": summary, "columns": self.__columns}
+        data = zlib.compress(json.dumps(frame).encode())
+        file = self.get_file()
+        file = getattr(file, "buffer", file)
+        file.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, len(data)) + data)
+        file.flush()
+
+
+def read_columnar(file):
+    """
+        Yields each frame written by ColumnarReporter as a dict of spec, summary and columns
+    """
+    while True:
+        header = file.read(COLUMNAR_HEADER.size)
+        if len(header) == 0:
+            return
+        if len(header) < COLUMNAR_HEADER.size:
+            raise ValueError("Truncated columnar results.")
+        magic, length = COLUMNAR_HEADER.unpack(header)
+        data = zlib.decompress(file.read(length))
+        if magic == COLUMNAR_MAGIC:
+            yield json.loads(data)
+        elif magic == MARSHAL_COLUMNAR_MAGIC:
+            try:
+                yield marshal.loads(data)
+            except (ValueError, EOFError, TypeError):
+                raise ValueError("These columnar results were written by a different version of Python.")
+        else:
+            raise ValueError("Not a columnar results file.")
+
+
+def frame_to_records(frame):
+    """
+        Turns a frame's columns back into one dict per test
+    """
+    columns = frame["columns"]
+    fields = [field for field in columns if any(value is not None for value in columns[field])]
+    count = len(columns["index"])
+    return [{field: columns[field][i] for field in fields} for i in range(count)]
+
+
+def get_reporter(format, formatter, filename=None):
+    """
+        formatter turns a TestRecord into the text shown for one test, see function_tester.format_record
+    """
+    if format == TEXT:
+        return TextReporter(formatter, open(filename, "w") if filename else None)
+    elif format == JSON_LINES:
+        return JsonLinesReporter(open(filename, "a") if filename else None)
+    elif format == COLUMNAR:
+        return ColumnarReporter(open(filename, "ab") if filename else None)
+    raise ValueError(f"Unknown result format {format}")
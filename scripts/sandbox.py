@@ -0,0 +1,347 @@
+from test_helper import TestLimits, TimeLimitExceeded, enforce_limits, fingerprint
+import dis
+import inspect
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import queue
+import sys
+import textwrap
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_MEMORY = 512
+# extra seconds the main process waits before deciding a worker is stuck rather than just slow
+GRACE = 5
+MAX_NAMESPACES = 64
+
+OK = "ok"
+ERROR = "error"
+TIMEOUT = "timeout"
+OOM = "oom"
+
+
+class SandboxError(RuntimeError):
+    """
+        The worker itself failed (crashed, or stopped responding), rather than the code it was running
+    """
+
+
+class SandboxedException(Exception):
+    """
+        An exception raised by code running in a worker, re-raised in the main process
+        type_name and line let PrettyError report it as if it had happened locally
+    """
+    def __init__(self, type_name, message, line):
+        super().__init__(message)
+        self.type_name = type_name
+        self.line = line
+
+
+# compiled code in each worker, keyed by source, so repeated calls don't exec it again
+_namespaces = {}
+
+
+def _init_worker(memory):
+    if resource is not None and memory is not None:
+        limit = int(memory * 1024 * 1024)
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _worker_loop(connection, memory):
+    _init_worker(memory)
+    while True:
+        try:
+            task, args = connection.recv()
+        except EOFError:
+            return
+        result = task(*args)
+        try:
+            connection.send(result)
+        except Exception as e:
+            connection.send((ERROR, (e.__class__.__name__, f"Couldn't send back the result: {e}", ""), None))
+
+
+def _get_namespace(source):
+    namespace = _namespaces.get(source)
+    if namespace is None:
+        if len(_namespaces) >= MAX_NAMESPACES:
+            _namespaces.clear()
+        namespace = {"__name__": "__sandbox__"}
+        exec(source, namespace)
+        _namespaces[source] = namespace
+    return namespace
+
+
+def _error_result(e):
+    data = traceback.extract_tb(sys.exc_info()[2])
+    line = data[-1][-1] if data else ""
+    return ERROR, (e.__class__.__name__, str(e), line), None
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return repr(value)
+
+
+def _sandbox_call(source, name, args, timeout):
+    before = fingerprint(args)
+    try:
+        namespace = _get_namespace(source)
+        with enforce_limits(TestLimits(timeout)):
+            value = namespace[name](*args)
+    except TimeLimitExceeded:
+        return TIMEOUT, None, None
+    except MemoryError:
+        return OOM, None, None
+    except Exception as e:
+        return _error_result(e)
+
+    # send back the arguments if they were changed, so the caller can see the modification
+    modified = args if fingerprint(args) != before else None
+    return OK, _picklable(value), modified
+
+
+def _sandbox_question_code(exec_code, eval_code, timeout):
+    from interactive_questions import run_question_code
+    try:
+        with enforce_limits(TestLimits(timeout)):
+            return OK, run_question_code(exec_code, eval_code), None
+    except TimeLimitExceeded:
+        return TIMEOUT, None, None
+    except MemoryError:
+        return OOM, None, None
+    except Exception as e:
+        return _error_result(e)
+
+
+def _write_back(originals, modified):
+    for original, new in zip(originals, modified):
+        if isinstance(original, list):
+            original[:] = new
+        elif isinstance(original, (dict, set)):
+            original.clear()
+            original.update(new)
+
+
+def _get_global_names(code):
+    """
+        Names code (and any function or class defined inside it) looks up as globals,
+        rather than every name it uses, which includes attributes such as the fabs of math.fabs
+    """
+    names = {instruction.argval for instruction in dis.get_instructions(code)
+             if instruction.opname in ("LOAD_GLOBAL", "LOAD_NAME", "STORE_GLOBAL", "DELETE_GLOBAL")}
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _get_global_names(const)
+    return names
+
+
+def _get_import(name, value, own_module):
+    """
+        The import statement that binds name to value in a new process, or None if there isn't one
+        Nothing is imported from own_module, the module of the function being rebuilt
+    """
+    if inspect.ismodule(value):
+        if value.__name__ == name:
+            return f"import {name}"
+        return f"import {value.__name__} as {name}"
+    module_name = getattr(value, "__module__", None)
+    attribute = getattr(value, "__name__", None)
+    if not isinstance(module_name, str) or not isinstance(attribute, str) or module_name == own_module:
+        return None
+    module = sys.modules.get(module_name)
+    # only values a module makes available under their own name, e.g. from math import sqrt
+    if module is None or module_name in ("__main__", "builtins") or getattr(module, attribute, None) is not value:
+        return None
+    if attribute == name:
+        return f"from {module_name} import {name}"
+    return f"from {module_name} import {attribute} as {name}"
+
+
+def get_function_source(fn):
+    """
+        Source for fn, plus the imports, functions and simple constants it uses from its globals,
+        so that it can be rebuilt in a worker
+        Raises RuntimeError if it uses a global that can't be rebuilt, e.g. an object made in the notebook
+    """
+    imports = []
+    sources = []
+    constants = []
+    seen = set()
+    pending = [fn]
+    while pending:
+        function = pending.pop()
+        if function.__name__ in seen:
+            continue
+        seen.add(function.__name__)
+        sources.append(textwrap.dedent(inspect.getsource(function)))
+        for name in sorted(_get_global_names(function.__code__)):
+            if name in seen or name not in function.__globals__:
+                # builtins, or globals the function makes itself
+                continue
+            value = function.__globals__[name]
+            statement = _get_import(name, value, function.__globals__.get("__name__"))
+            if statement is not None:
+                seen.add(name)
+                imports.append(statement)
+            elif inspect.isfunction(value):
+                pending.append(value)
+            elif value is None or isinstance(value, (int, float, str, bool, list, dict, tuple, set)):
+                seen.add(name)
+                constants.append(f"{name} = {value!r}")
+            else:
+                raise RuntimeError(f"Can't run {fn.__name__} in the sandbox, it uses {name} "
+                                   f"({type(value).__name__}), which can't be rebuilt in another process")
+    return "\n".join(imports + constants + sources[::-1])
+
+
+class SandboxedFunction:
+    """
+        Calls a function defined by source in a SandboxPool worker
+        Behaves like the real function: errors, timeouts and modified arguments show up in the caller
+    """
+    def __init__(self, pool, source, name):
+        self.__pool = pool
+        self.__source = source
+        self.__name = name
+        self.__name__ = name
+
+    def __call__(self, *args):
+        try:
+            value, modified = self.__pool.submit(_sandbox_call, self.__source, self.__name, list(args))
+        except SandboxError as e:
+            # what PrettyError shows as the line that went wrong, rather than the line in this file
+            e.line = f"{self.__name}(...)"
+            raise
+        if modified is not None:
+            _write_back(args, modified)
+        return value
+
+
+class SandboxWorker:
+    """
+        One worker process, and the pipe its tasks are sent down
+    """
+    def __init__(self, context, memory):
+        self.__connection, child = context.Pipe()
+        self.__process = context.Process(target=_worker_loop, args=(child, memory), daemon=True)
+        self.__process.start()
+        child.close()
+
+    def call(self, task, args, timeout):
+        """
+            Returns task(*args) from the worker
+            Raises TimeoutError if it takes longer than timeout, EOFError as soon as the worker dies
+        """
+        self.__connection.send((task, args))
+        ready = multiprocessing.connection.wait([self.__connection, self.__process.sentinel], timeout)
+        if len(ready) == 0:
+            raise TimeoutError()
+        if self.__connection in ready:
+            # a dead worker's pipe is ready too, but has nothing in it
+            try:
+                return self.__connection.recv()
+            except EOFError:
+                pass
+        self.__process.join()
+        raise EOFError(f"it stopped with exit code {self.__process.exitcode}")
+
+    def stop(self):
+        self.__process.kill()
+        self.__process.join()
+        self.__connection.close()
+
+
+class SandboxPool:
+    """
+        Pre-started worker processes for running untrusted code: spec solutions, quiz questions
+        and student functions. A worker that crashes or stops responding is replaced.
+    """
+    def __init__(self, workers=1, timeout=DEFAULT_TIMEOUT, memory=DEFAULT_MEMORY):
+        self.__workers = workers
+        self.__timeout = timeout
+        self.__memory = memory
+        if "fork" in multiprocessing.get_all_start_methods():
+            self.__context = multiprocessing.get_context("fork")
+        else:
+            self.__context = multiprocessing.get_context("spawn")
+        self.__idle = queue.Queue()
+        self.__start()
+
+    def __start(self):
+        for _ in range(self.__workers):
+            self.__idle.put(SandboxWorker(self.__context, self.__memory))
+
+    def restart(self):
+        """
+            Replaces the idle workers, any that are busy are left to finish
+        """
+        self.close()
+        self.__start()
+
+    def close(self):
+        while True:
+            try:
+                self.__idle.get_nowait().stop()
+            except queue.Empty:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def submit(self, task, *args):
+        """
+            Runs task(*args, timeout) in a worker, returning (value, modified arguments)
+        """
+        backstop = self.__timeout + GRACE if self.__timeout is not None else None
+        worker = self.__idle.get()
+        try:
+            status, value, modified = worker.call(task, (*args, self.__timeout), backstop)
+        except TimeoutError:
+            worker.stop()
+            worker = SandboxWorker(self.__context, self.__memory)
+            raise TimeLimitExceeded(self.__timeout)
+        except (OSError, EOFError) as e:
+            worker.stop()
+            worker = SandboxWorker(self.__context, self.__memory)
+            raise SandboxError(f"The sandbox worker failed: {e}")
+        except Exception as e:
+            # the task couldn't be sent, e.g. an argument that can't be pickled, so the worker is still fine
+            raise SandboxError(f"Couldn't send the code to the sandbox: {e}")
+        finally:
+            self.__idle.put(worker)
+
+        if status == TIMEOUT:
+            raise TimeLimitExceeded(self.__timeout)
+        elif status == OOM:
+            raise MemoryError()
+        elif status == ERROR:
+            raise SandboxedException(*value)
+        return value, modified
+    def function(self, source, name):
+        return SandboxedFunction(self, source, name)
+
+    def wrap(self, fn):
+        return SandboxedFunction(self, get_function_source(fn), fn.__name__)
+
+    def run_question_code(self, exec_code, eval_code):
+        """
+            A drop in for interactive_questions.run_question_code, see set_question_code_runner
+        """
+        value, _ = self.submit(_sandbox_question_code, exec_code, eval_code)
+        return value
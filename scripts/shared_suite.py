@@ -0,0 +1,122 @@
+from test_helper import Test
+from multiprocessing import shared_memory
+import pickle
+import struct
+
+# the segment starts with the length of the header, then the header (the suite's name and where each
+# test's bytes are), then each test pickled on its own
+HEADER_LENGTH = struct.Struct(">Q")
+
+
+class SharedSuite:
+    """
+        Publishes a compiled suite once, in shared memory, for worker processes to attach to by name
+        Whoever creates it must close it, which removes the shared memory
+    """
+    def __init__(self, suite):
+        blobs = [pickle.dumps(test) for test in suite.get_tests() + suite.get_secret_tests()]
+        offsets = []
+        offset = 0
+        for blob in blobs:
+            offsets.append((offset, len(blob)))
+            offset += len(blob)
+        count = len(suite.get_tests())
+        header = pickle.dumps({"name": suite.get_name(), "tests": offsets[:count], "secret_tests": offsets[count:]})
+        start = HEADER_LENGTH.size + len(header)
+
+        self.__memory = shared_memory.SharedMemory(create=True, size=max(start + offset, 1))
+        self.__memory.buf[:start] = HEADER_LENGTH.pack(len(header)) + header
+        for (offset, length), blob in zip(offsets, blobs):
+            self.__memory.buf[start + offset:start + offset + length] = blob
+
+    def get_name(self):
+        return self.__memory.name
+
+    def close(self):
+        self.__memory.close()
+        self.__memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class SharedTest(Test):
+    """
+        A test whose inputs and expected output stay in shared memory
+        Each run unpickles a private copy, runs it, and keeps only the results
+    """
+    def __init__(self, memory, start, end):
+        super().__init__(None, None)
+        self.__memory = memory
+        self.__start = start
+        self.__end = end
+        self.__default_limits = None
+
+    def load(self):
+        # the view is released straight away, so the shared memory can still be closed
+        with self.__memory.buf[self.__start:self.__end] as blob:
+            return pickle.loads(blob)
+
+    def get_inputs(self):
+        return self.load().get_inputs()
+
+    def get_expected(self):
+        return self.load().get_expected()
+
+    def get_hint(self):
+        return self.load().get_hint()
+
+    def get_limits(self):
+        test = self.load()
+        if self.__default_limits is not None:
+            test.add_default_limits(self.__default_limits)
+        return test.get_limits()
+
+    def add_default_limits(self, limits):
+        if self.__default_limits is None or limits is None:
+            self.__default_limits = limits
+        else:
+            self.__default_limits = self.__default_limits.with_defaults(limits)
+
+    def run(self, func, instrumented=False):
+        test = self.load()
+        if self.__default_limits is not None:
+            test.add_default_limits(self.__default_limits)
+        # nothing else sees this copy, so it needn't be copied again
+        test.set_disposable()
+        result = test.run(func, instrumented)
+        self.record_run(test.get_output(), test.get_result(), test.get_outcome(), test.get_metrics(),
+                        test.get_elapsed(), test.get_mismatch())
+        return result
+
+
+class AttachedSuite:
+    """
+        A worker's read-only view of a SharedSuite, with the same methods as a CompiledSuite
+    """
+    def __init__(self, name):
+        self.__memory = shared_memory.SharedMemory(name=name)
+        with self.__memory.buf[:HEADER_LENGTH.size] as header_length:
+            start = HEADER_LENGTH.size + HEADER_LENGTH.unpack(header_length)[0]
+        with self.__memory.buf[HEADER_LENGTH.size:start] as header:
+            header = pickle.loads(header)
+        self.__name = header["name"]
+        self.__tests = [SharedTest(self.__memory, start + offset, start + offset + length)
+                        for offset, length in header["tests"]]
+        self.__secret_tests = [SharedTest(self.__memory, start + offset, start + offset + length)
+                               for offset, length in header["secret_tests"]]
+
+    def get_name(self):
+        return self.__name
+
+    def get_tests(self):
+        return self.__tests
+
+    def get_secret_tests(self):
+        return self.__secret_tests
+
+    def close(self):
+        self.__memory.close()
@@ -1,4 +1,5 @@
-from test_helper import Test, TestSpec
+from test_helper import Test, PerfTest, load_compiled_suite
+from spec_catalogue import resolve_spec
 import sys
 import textwrap
 
@@ -22,6 +23,18 @@ def format_test(test, name):
     return f"{name}({format_inputs(test.get_inputs())}) -> {format_expected(test.get_expected())}"
 
 
+def show_examples(filename, load_suite=load_compiled_suite, count=5):
+    suite = load_suite(resolve_spec(filename))
+
+    # timing tests don't make useful examples
+    tests = [test for test in suite.get_tests() if not isinstance(test, PerfTest)]
+
+    print(f"Example tests for function {suite.get_name()}\n")
+    tot = min(count, len(tests))
+    for i in range(tot):
+        print(f"Test {i + 1}/{tot}: {format_test(tests[i], suite.get_name())}")
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         raise RuntimeError("Need to provide test spec file as argument.")
@@ -31,11 +44,4 @@ if __name__ == "__main__":
     else:
         filename = sys.argv[1]
 
-    test_spec = TestSpec(filename)
-
-    tests, _ = test_spec.generate_tests()
-
-    print(f"Example tests for function {test_spec.get_name()}\n")
-    tot = min(5, len(tests))
-    for i in range(tot):
-        print(f"Test {i + 1}/{tot}: {format_test(tests[i], test_spec.get_name())}")
+    show_examples(filename)
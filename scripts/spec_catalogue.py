@@ -0,0 +1,226 @@
+from test_helper import load_compiled_suite, nth_word
+from interactive_questions import load_formats_from_file
+import argparse
+import json
+import os
+import re
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATALOGUE_FILE = "__speccatalogue__.json"
+CATALOGUE_VERSION = 1
+QUESTIONS_DIR = "questions"
+SPEC = "spec"
+QUESTIONS = "questions"
+
+
+def get_chapter(path):
+    match = re.search(r"Chapter (\d+)", path)
+    return int(match.group(1)) if match else None
+
+
+def read_spec_metadata(filename):
+    """
+        The name, input kinds and limits of a spec, without evaluating any of it
+    """
+    name = None
+    inputs = []
+    limits = {}
+    mode = None
+    with open(filename, "r") as spec_file:
+        for line in spec_file:
+            line = line.rstrip()
+            if line.startswith("//"):
+                continue
+            if line.startswith("*"):
+                mode = nth_word(line, 0)[1:]
+                if mode == "in":
+                    inputs.append(nth_word(line, 1))
+                elif mode == "perf":
+                    inputs.append("perf")
+            elif mode == "name" and name is None and line != "":
+                name = line
+            elif mode == "limits" and line.strip() != "":
+                limits[nth_word(line, 0)] = float(nth_word(line, 1))
+    return {"name": name, "inputs": inputs, "limits": limits}
+
+
+def read_questions_metadata(filename):
+    formats = load_formats_from_file(filename)
+    return {"name": os.path.basename(filename)[:-len("q.txt")], "formats": len(formats),
+            "levels": sorted({question_format.get_level() for question_format in formats})}
+
+
+def get_kind(path):
+    """
+        Specs are questions/<section>/<name>, question files are questions/<name>q.txt
+    """
+    parent = os.path.dirname(path)
+    if os.path.basename(parent) == QUESTIONS_DIR:
+        return QUESTIONS if path.endswith("q.txt") else None
+    elif os.path.basename(os.path.dirname(parent)) == QUESTIONS_DIR:
+        return SPEC
+    return None
+
+
+class SpecCatalogue:
+    """
+        An index of every spec and question file under root, by name, chapter and section
+        Saved as JSON with each file's mtime and size, so refresh() only re-reads files that changed
+    """
+    def __init__(self, root=ROOT, filename=None):
+        self.__root = os.path.realpath(root)
+        self.__filename = filename if filename is not None else os.path.join(self.__root, CATALOGUE_FILE)
+        self.__entries = {}
+        self.__by_name = {}
+        self.__load()
+
+    def __load(self):
+        try:
+            with open(self.__filename, "r") as catalogue_file:
+                saved = json.load(catalogue_file)
+        except (OSError, ValueError):
+            return
+        if saved.get("version") == CATALOGUE_VERSION and saved.get("root") == self.__root:
+            self.__entries = saved["entries"]
+            self.__index()
+
+    def __index(self):
+        self.__by_name = {}
+        for path, entry in sorted(self.__entries.items()):
+            self.__by_name.setdefault(entry["name"], []).append(path)
+
+    def save(self):
+        temp_filename = f"{self.__filename}.{os.getpid()}.tmp"
+        try:
+            with open(temp_filename, "w") as catalogue_file:
+                json.dump({"version": CATALOGUE_VERSION, "root": self.__root, "entries": self.__entries},
+                          catalogue_file, indent=1)
+            os.replace(temp_filename, self.__filename)
+        except OSError:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def find_files(self):
+        files = []
+        for directory, subdirectories, filenames in os.walk(self.__root):
+            # skip caches and hidden directories
+            subdirectories[:] = sorted(d for d in subdirectories if not d.startswith(("__", ".")))
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if get_kind(path) is not None:
+                    files.append(os.path.relpath(path, self.__root))
+        return files
+
+    def __is_current(self, path, entry):
+        try:
+            stat = os.stat(os.path.join(self.__root, path))
+        except OSError:
+            return False
+        return entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size
+
+    def __read_entry(self, path):
+        full_path = os.path.join(self.__root, path)
+        stat = os.stat(full_path)
+        kind = get_kind(full_path)
+        if kind == SPEC:
+            entry = read_spec_metadata(full_path)
+            entry["section"] = os.path.basename(os.path.dirname(path))
+        else:
+            entry = read_questions_metadata(full_path)
+        entry.update({"kind": kind, "chapter": get_chapter(path), "mtime": stat.st_mtime_ns, "size": stat.st_size})
+        return entry
+
+    def refresh(self):
+        """
+            Re-reads new and changed files and drops deleted ones, returns how many entries changed
+        """
+        files = self.find_files()
+        changed = len(set(self.__entries) - set(files))
+        entries = {}
+        for path in files:
+            entry = self.__entries.get(path)
+            if entry is None or not self.__is_current(path, entry):
+                try:
+                    entry = self.__read_entry(path)
+                except (OSError, ValueError, UnicodeDecodeError):
+                    continue
+                changed += 1
+            entries[path] = entry
+        self.__entries = entries
+        self.__index()
+        return changed
+
+    def get_root(self):
+        return self.__root
+
+    def get_entries(self):
+        return self.__entries
+
+    def find(self, name, kind=None, chapter=None):
+        """
+            Paths (relative to root) of the files called name, only stat'ing the ones it finds
+            If any of them has changed since it was catalogued, the catalogue is refreshed first
+        """
+        paths = self.__by_name.get(name, [])
+        if not paths or not all(self.__is_current(path, self.__entries[path]) for path in paths):
+            if self.refresh() > 0:
+                self.save()
+            paths = self.__by_name.get(name, [])
+        return [path for path in paths
+                if (kind is None or self.__entries[path]["kind"] == kind)
+                and (chapter is None or self.__entries[path]["chapter"] == chapter)]
+
+    def resolve(self, name, kind=SPEC, chapter=None):
+        """
+            The full path of the one file called name, e.g. "collatz" or "2.2.1" for a question file
+        """
+        paths = self.find(name, kind, chapter)
+        if len(paths) == 0:
+            raise FileNotFoundError(f"No {kind} called {name}")
+        elif len(paths) > 1:
+            raise ValueError(f"More than one {kind} called {name}, give a chapter: " + ", ".join(paths))
+        return os.path.join(self.__root, paths[0])
+
+    def load_suite(self, name, chapter=None, **kwargs):
+        return load_compiled_suite(self.resolve(name, SPEC, chapter), **kwargs)
+
+
+def resolve_spec(spec, root=ROOT):
+    """
+        spec if it's a file, otherwise the path of the spec with that name
+    """
+    if os.path.isfile(spec):
+        return spec
+    return SpecCatalogue(root).resolve(spec)
+
+
+def format_catalogue(entries):
+    lines = []
+    for path, entry in sorted(entries.items(), key=lambda item: (item[1]["chapter"] or 0, item[0])):
+        if entry["kind"] == SPEC:
+            details = ", ".join(entry["inputs"])
+        else:
+            details = f"{entry['formats']} formats"
+        lines.append(f"{entry['chapter']}\t{entry['kind']}\t{entry['name']}\t{details}\t{path}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index every test spec and question file by name.")
+    parser.add_argument("name", nargs="?", help="print the path of the spec or question file with this name")
+    parser.add_argument("--root", default=ROOT)
+    parser.add_argument("--chapter", type=int, default=None)
+    parser.add_argument("--rebuild", action="store_true", help="re-read every file, not just changed ones")
+    args = parser.parse_args()
+
+    catalogue = SpecCatalogue(args.root)
+    if args.rebuild:
+        catalogue.get_entries().clear()
+    changed = catalogue.refresh()
+    catalogue.save()
+
+    if args.name:
+        print("\n".join(catalogue.find(args.name, chapter=args.chapter)))
+    else:
+        print(format_catalogue(catalogue.get_entries()))
+        print(f"\n{len(catalogue.get_entries())} files, {changed} re-read")
@@ -1,13 +1,59 @@
+from random_streams import derive_rng
+from comparators import DEFAULT_COMPARATOR, parse_comparator, values_equal, fingerprint
 import random
+import ast
 import math
 import numbers
 import traceback
 import sys
-from typing import Iterable
+from typing import Iterable, Sequence
+import itertools
+import array
 import copy
+import hashlib
+import json
+import os
+import pickle
+import re
+import contextlib
+import signal
+import threading
+import multiprocessing
+import time
+import tracemalloc
+import types
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, memory limits are skipped there
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    # matrix inputs are generated in pure Python instead
+    numpy = None
 
-random.seed(0)
 boolrange = (False, True)
+# what generates matrix inputs, see MatrixInput
+MATRIX_BACKEND = f"numpy {numpy.__version__}" if numpy is not None else "random"
+
+# compiled suites are cached next to the spec file, keyed by the spec contents and seed
+SEED = 0
+CACHE_DIR = "__testcache__"
+CACHE_VERSION = 11
+
+PASS = "PASS"
+FAIL = "FAIL"
+TIMEOUT = "TIMEOUT"
+OOM = "OOM"
+# how many times in a row a *in random line can draw inputs that are already tested before giving up
+MAX_DUPLICATE_DRAWS = 1000
+# extra seconds a parallel test run gets past its time limit before its worker is assumed to have died
+WORKER_GRACE = 5
+# how often a parallel run checks that the worker running a test is still alive
+WORKER_POLL = 0.1
 
 
 class ModifiedInput:
@@ -28,23 +74,328 @@ class PrettyError:
         return self.__repr__()
 
     def __repr__(self):
+        # errors re-raised from another process (see sandbox.py) carry the original type's name
+        type_name = getattr(self.__exception, "type_name", self.__exception.__class__.__name__)
         return f"An error occurred on the line:" \
                f"\n\t          {self.__line}" \
                f"\n\t        The error was:" \
-               f"\n\t          {self.__exception.__class__.__name__}: {self.__exception}"
+               f"\n\t          {type_name}: {self.__exception}"
+
+
+class TimedOut:
+    def __init__(self, timeout):
+        self.__timeout = timeout
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        if self.__timeout is None:
+            return "Your code took too long and was stopped."
+        return f"Your code took longer than {self.__timeout:g} seconds and was stopped."
+
+
+class OutOfMemory:
+    def __init__(self, memory):
+        self.__memory = memory
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        if self.__memory is None:
+            return "Your code ran out of memory and was stopped."
+        return f"Your code used more than {self.__memory:g}MB of memory and was stopped."
+
+
+class TimeLimitExceeded(BaseException):
+    """
+        Raised inside the tested function when it runs for too long
+        Derives from BaseException so that "except Exception" in student code can't swallow it
+    """
+
+
+class TestLimits:
+    """
+        Wall-clock (seconds) and extra memory (megabytes) allowed for one call of the tested function
+        None means unlimited
+    """
+    def __init__(self, timeout=None, memory=None):
+        self.__timeout = timeout
+        self.__memory = memory
+
+    def get_timeout(self):
+        return self.__timeout
+
+    def get_memory(self):
+        return self.__memory
+
+    def is_limited(self):
+        return self.__timeout is not None or self.__memory is not None
+
+    def with_defaults(self, defaults):
+        """
+            Fills in any limit not set here from defaults
+        """
+        if defaults is None:
+            return self
+        timeout = self.__timeout if self.__timeout is not None else defaults.get_timeout()
+        memory = self.__memory if self.__memory is not None else defaults.get_memory()
+        return TestLimits(timeout, memory)
+
+    def __repr__(self):
+        return "timeout: {}, memory: {}".format(self.__timeout, self.__memory)
+
+
+def _raise_time_limit(signum, frame):
+    raise TimeLimitExceeded()
+
+
+def _current_address_space():
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            pages = int(statm.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+NO_LIMITS = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def enforce_limits(limits):
+    """
+        The time limit uses SIGALRM, so only applies on the main thread of a Unix process
+        The memory limit lowers RLIMIT_AS for the whole process while the function runs
+    """
+    use_timer = limits is not None and limits.get_timeout() is not None \
+        and hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+    use_memory = limits is not None and limits.get_memory() is not None and resource is not None
+
+    old_handler = None
+    old_rlimit = None
+    if use_memory:
+        address_space = _current_address_space()
+        if address_space is not None:
+            old_rlimit = resource.getrlimit(resource.RLIMIT_AS)
+            new_soft = address_space + int(limits.get_memory() * 1024 * 1024)
+            if old_rlimit[1] != resource.RLIM_INFINITY:
+                new_soft = min(new_soft, old_rlimit[1])
+            resource.setrlimit(resource.RLIMIT_AS, (new_soft, old_rlimit[1]))
+    if use_timer:
+        old_handler = signal.signal(signal.SIGALRM, _raise_time_limit)
+        signal.setitimer(signal.ITIMER_REAL, limits.get_timeout())
+
+    try:
+        yield
+    finally:
+        if use_timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+        if old_rlimit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, old_rlimit)
+
+
+# the usual inputs, checked by exact type first since isinstance with numbers.Number is slow
+IMMUTABLE_TYPES = frozenset((int, float, complex, bool, str, bytes, type(None), range))
+
+
+def is_immutable(obj):
+    if type(obj) in IMMUTABLE_TYPES:
+        return True
+    elif isinstance(obj, (tuple, frozenset)):
+        return all(is_immutable(x) for x in obj)
+    return isinstance(obj, (numbers.Number, str, bytes, type(None), range))
+
+
+class MatrixInput:
+    """
+        A rows x cols grid of random numbers, stored as just its shape, distribution and seed
+        The list of lists is generated (vectorised with numpy where possible) when a test is first run,
+        so big grids aren't kept in memory before then, pickled into the suite cache, or deep copied
+    """
+    DISTRIBUTIONS = ("randrange", "uniform")
+    # numpy's integers() only covers int64
+    INT64_RANGE = (-2 ** 63, 2 ** 63)
+
+    def __init__(self, rows, cols, distribution, low, high, seed):
+        if distribution not in MatrixInput.DISTRIBUTIONS:
+            raise RuntimeError("Matrices only support " + ", ".join(MatrixInput.DISTRIBUTIONS))
+        if distribution == "randrange":
+            low, high = int(low), int(high)
+        self.__rows = rows
+        self.__cols = cols
+        self.__distribution = distribution
+        self.__low = low
+        self.__high = high
+        self.__seed = seed
+        # numpy and random give different grids for the same seed, so always use the one the answer came from
+        lowest, highest = MatrixInput.INT64_RANGE
+        in_range = distribution == "uniform" or (low >= lowest and high <= highest)
+        self.__use_numpy = numpy is not None and in_range
+
+    def get_shape(self):
+        return self.__rows, self.__cols
+
+    def materialise(self):
+        shape = (self.__rows, self.__cols)
+        if self.__use_numpy:
+            if numpy is None:
+                raise RuntimeError("This matrix input was generated with numpy, which isn't installed")
+            rng = numpy.random.default_rng(self.__seed)
+            if self.__distribution == "randrange":
+                return rng.integers(self.__low, self.__high, size=shape).tolist()
+            return rng.uniform(self.__low, self.__high, size=shape).tolist()
+
+        # without numpy, draw all the random bits at once into an array, which is still a few times
+        # quicker than calling randrange for every number (the tiny modulo bias doesn't matter for tests)
+        rng = random.Random(self.__seed)
+        count = self.__rows * self.__cols
+        low, width = self.__low, self.__high - self.__low
+        if self.__distribution == "uniform":
+            scale = width / 2 ** 53
+            values = [low + (bits >> 11) * scale for bits in array.array("Q", rng.randbytes(8 * count))]
+        elif width <= 2 ** 64:
+            values = [low + bits % width for bits in array.array("Q", rng.randbytes(8 * count))]
+        else:
+            values = [rng.randrange(low, self.__high) for _ in range(count)]
+        return [values[i:i + self.__cols] for i in range(0, count, self.__cols)]
+
+    def __key(self):
+        return self.__rows, self.__cols, self.__distribution, self.__low, self.__high, self.__seed, self.__use_numpy
+
+    def __eq__(self, other):
+        return isinstance(other, MatrixInput) and self.__key() == other.__key()
+
+    def __hash__(self):
+        return hash(self.__key())
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return f"<{self.__rows}x{self.__cols} matrix of {self.__distribution}({self.__low}, {self.__high})>"
+
+
+def grid_snapshot(grid):
+    """
+        A copy of a list of lists that compares equal only to an equal grid, much quicker to make than fingerprint
+        Kept whole rather than hashed, since different grids can share a hash
+    """
+    rows = tuple(map(tuple, grid))
+    try:
+        hash(rows)
+        return rows
+    except TypeError:
+        return fingerprint(grid)
+
+
+def materialise_inputs(inputs):
+    return [x.materialise() if isinstance(x, MatrixInput) else x for x in inputs]
+
+
+class TestMetrics:
+    """
+        What one run of the tested function cost: wall and CPU seconds, peak bytes allocated,
+        how many times the function was called (including recursive calls) and how deep the recursion went
+    """
+    def __init__(self):
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = 0
+        self.calls = 0
+        self.max_depth = 0
+
+    def to_dict(self):
+        return {"wall_time": self.wall_time, "cpu_time": self.cpu_time, "peak_memory": self.peak_memory,
+                "calls": self.calls, "max_depth": self.max_depth}
+
+    def __repr__(self):
+        return "wall: {:.6f}s, cpu: {:.6f}s, peak: {}B, calls: {}, depth: {}".format(
+            self.wall_time, self.cpu_time, self.peak_memory, self.calls, self.max_depth)
+
+
+@contextlib.contextmanager
+def instrument(func, metrics):
+    """
+        Fills in metrics for the code run inside the with block
+        Calls are only counted for plain Python functions, by profiling calls to func's code object
+    """
+    code = getattr(func, "__code__", None)
+    depth = 0
+
+    def profile(frame, event, arg):
+        nonlocal depth
+        if frame.f_code is code:
+            if event == "call":
+                metrics.calls += 1
+                depth += 1
+                metrics.max_depth = max(metrics.max_depth, depth)
+            elif event == "return":
+                depth -= 1
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    old_profile = sys.getprofile()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if code is not None:
+        sys.setprofile(profile)
+    try:
+        yield metrics
+    finally:
+        sys.setprofile(old_profile)
+        metrics.cpu_time = time.process_time() - cpu_start
+        metrics.wall_time = time.perf_counter() - wall_start
+        metrics.peak_memory = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def summarise_metrics(tests):
+    """
+        Totals and maxima over the tests that were run with instrument=True
+    """
+    metrics = [test.get_metrics() for test in tests if test.get_metrics() is not None]
+    if len(metrics) == 0:
+        return {"tests": 0}
+    return {"tests": len(metrics),
+            "total_wall_time": sum(m.wall_time for m in metrics),
+            "max_wall_time": max(m.wall_time for m in metrics),
+            "total_cpu_time": sum(m.cpu_time for m in metrics),
+            "max_cpu_time": max(m.cpu_time for m in metrics),
+            "max_peak_memory": max(m.peak_memory for m in metrics),
+            "total_calls": sum(m.calls for m in metrics),
+            "max_calls": max(m.calls for m in metrics),
+            "max_depth": max(m.max_depth for m in metrics)}
 
 
 class Test:
-    def __init__(self, inputs, expected, hint=""):
+    def __init__(self, inputs, expected, hint="", limits=None):
+        # these are never handed to the tested function, runs share a copy until one of them changes it
         self.__inputs = inputs
-        self.__original_inputs = copy.deepcopy(inputs)
+        self.__immutable = None
+        self.__expanded = None
+        self.__working = None
+        self.__snapshot = None
         self.__expected = expected
         self.__hint = hint
+        self.__limits = limits
         self.__output = None
         self.__result = None
+        self.__outcome = None
+        self.__metrics = None
+        self.__elapsed = None
+        self.__comparator = None
+        self.__mismatch = None
+        self.__disposable = False
 
     def get_inputs(self):
-        return self.__original_inputs
+        return self.__inputs
 
     def get_expected(self):
         return self.__expected
@@ -58,38 +409,474 @@ class Test:
     def get_result(self):
         return self.__result
 
+    def get_outcome(self):
+        return self.__outcome
+
+    def get_metrics(self):
+        return self.__metrics
+
+    def get_elapsed(self):
+        """
+            Wall clock seconds the last run spent in the tested function, or None if it didn't finish
+        """
+        return self.__elapsed
+
+    def get_limits(self):
+        return self.__limits
+
+    def set_limits(self, limits):
+        self.__limits = limits
+
+    def get_mismatch(self):
+        """
+            Where a wrong output first differed from the expected one, see comparators.Mismatch
+        """
+        return self.__mismatch
+
+    def get_comparator(self):
+        return self.__comparator if self.__comparator is not None else DEFAULT_COMPARATOR
+
+    def set_comparator(self, comparator):
+        self.__comparator = comparator
+
+    def set_disposable(self):
+        """
+            For a test that was loaded to be run once and thrown away (see shared_suite.SharedTest):
+            its own inputs are already a private copy, so they're handed to the function without copying
+        """
+        self.__disposable = True
+
+    def record_run(self, output, result, outcome, metrics=None, elapsed=None, mismatch=None):
+        """
+            Stores the outcome of a run that happened elsewhere, e.g. in a worker process
+        """
+        self.__output = output
+        self.__result = result
+        self.__outcome = outcome
+        self.__metrics = metrics
+        self.__elapsed = elapsed
+        self.__mismatch = mismatch
+
+    def add_default_limits(self, limits):
+        if self.__limits is None:
+            self.__limits = limits
+        else:
+            self.__limits = self.__limits.with_defaults(limits)
+
     def __str__(self):
         return self.__repr__()
 
     def __repr__(self):
         return "inputs: {}, expected: {}".format(self.get_inputs(), self.get_expected())
 
-    def run(self, func):
+    def __is_immutable(self):
+        """
+            Whether the inputs can't be modified at all, so can be handed over as they are
+            Worked out on the first run rather than when the test is generated
+        """
+        if self.__immutable is None:
+            self.__immutable = all(is_immutable(x) for x in self.__inputs)
+        return self.__immutable
+
+    def __has_matrices(self):
+        return any(isinstance(x, MatrixInput) for x in self.__inputs)
+
+    def __get_expanded(self):
+        """
+            The inputs with any matrices generated, made on the first run and kept for checking later runs
+        """
+        if self.__expanded is None:
+            self.__expanded = materialise_inputs(self.__inputs) if self.__has_matrices() else self.__inputs
+        return self.__expanded
+
+    def __take_snapshot(self, inputs):
+        return [grid_snapshot(x) if isinstance(original, MatrixInput) else fingerprint(x)
+                for x, original in zip(inputs, self.__inputs)]
+
+    def __get_snapshot(self):
+        """
+            An exact record of the inputs, for when == can't say whether they're unchanged (e.g. numpy arrays),
+            and for disposable tests, which have no copy to compare to
+        """
+        if self.__snapshot is None:
+            self.__snapshot = self.__take_snapshot(self.__get_expanded())
+        return self.__snapshot
+
+    def __fresh_inputs(self):
+        """
+            The inputs for the next run, copied only on the first run or after a run that might have changed them
+        """
+        if self.__is_immutable():
+            return self.__inputs
+        elif self.__working is not None:
+            return self.__working
+        elif self.__disposable:
+            # nothing else will use these inputs, so all that's needed is a record of them to check against
+            self.__get_snapshot()
+            return self.__get_expanded()
+        elif self.__has_matrices():
+            # a grid only holds numbers, so copying its rows is enough, and much quicker than deepcopy
+            return [[row[:] for row in x] if isinstance(original, MatrixInput) else copy.deepcopy(x)
+                    for x, original in zip(self.__get_expanded(), self.__inputs)]
+        return copy.deepcopy(self.__inputs)
+
+    def __was_modified(self, inputs):
+        if self.__is_immutable():
+            return False
+        expanded = self.__get_expanded()
+        if inputs is not expanded and values_equal(inputs, expanded):
+            return False
+        return self.__take_snapshot(inputs) != self.__get_snapshot()
+
+    def run(self, func, instrumented=False):
+        self.__result = False
+        self.__outcome = FAIL
+        self.__metrics = TestMetrics() if instrumented else None
+        self.__elapsed = None
+        self.__mismatch = None
+        inputs = self.__fresh_inputs()
+        # taken back only once this run is known to have left it alone
+        self.__working = None
+        # most tests have no limits, and setting up enforce_limits costs more than calling a small function
+        limited = self.__limits is not None and self.__limits.is_limited()
         try:
-            self.__output = func(*self.__inputs)
+            with enforce_limits(self.__limits) if limited else NO_LIMITS:
+                start = time.perf_counter()
+                if instrumented:
+                    with instrument(func, self.__metrics):
+                        self.__output = func(*inputs)
+                else:
+                    self.__output = func(*inputs)
+                self.__elapsed = time.perf_counter() - start
+        except TimeLimitExceeded as e:
+            # the time limit may have been enforced elsewhere, e.g. by a sandbox worker
+            timeout = e.args[0] if e.args else self.__limits.get_timeout()
+            self.__output = TimedOut(timeout)
+            self.__outcome = TIMEOUT
+            return False
+        except MemoryError:
+            self.__output = OutOfMemory(self.__limits.get_memory() if self.__limits is not None else None)
+            self.__outcome = OOM
+            return False
         except Exception as e:
             # this hideousness extracts the line of code that caused the error
             data = traceback.extract_tb(sys.exc_info()[2])
-            line = data[-1][-1]
+            line = getattr(e, "line", None) or data[-1][-1]
             self.__output = PrettyError(e, line)
             # for now assume no deliberate errors... might need to change this
             return False
 
-        if self.__inputs != self.__original_inputs:
+        if self.__was_modified(inputs):
             self.__output = ModifiedInput()
             return False
-        # testing for equality usually requires horrible type checking
-        elif self.__output is None or self.__expected is None:
-            self.__result = self.__output == self.__expected
-        elif isinstance(self.__expected, numbers.Number):
-            # allow 'close enough' for floats
-            # noinspection PyTypeChecker
-            self.__result = math.isclose(self.__output, self.__expected)
-        else:
-            self.__result = self.__output == self.__expected
+        self.__working = inputs
+        self.__mismatch = self.get_comparator().compare(self.__expected, self.__output)
+        self.__result = self.__mismatch is None
+        if self.__result:
+            self.__outcome = PASS
         return self.__result
 
 
+class LostRun:
+    """
+        The output of a test whose worker process died, or stopped responding, before sending back a result
+    """
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return "Your code crashed or stopped responding, so the test couldn't finish."
+
+
+class UnpicklableOutput:
+    """
+        Stands in for a worker's output that couldn't be sent back to the main process
+    """
+    def __init__(self, output):
+        self.__repr = repr(output)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return self.__repr
+
+
+# set in each worker by _share_tests, inherited through fork so the function is never pickled
+_shared_fn = None
+_shared_tests = None
+_shared_instrumented = False
+# the pid of the worker running each test, 0 until one starts it
+_shared_owners = None
+
+
+def _share_tests(fn, tests, instrumented, owners):
+    global _shared_fn, _shared_tests, _shared_instrumented, _shared_owners
+    _shared_fn = fn
+    _shared_tests = tests
+    _shared_instrumented = instrumented
+    _shared_owners = owners
+
+
+def _run_shared_test(i):
+    _shared_owners[i] = os.getpid()
+    test = _shared_tests[i]
+    try:
+        test.run(_shared_fn, _shared_instrumented)
+    except BaseException as e:
+        # e.g. sys.exit(), which would otherwise take the worker down with it
+        data = traceback.extract_tb(sys.exc_info()[2])
+        test.record_run(PrettyError(e, data[-1][-1] if data else ""), False, FAIL)
+    output = test.get_output()
+    try:
+        pickle.dumps(output)
+    except Exception:
+        output = UnpicklableOutput(output)
+    return i, output, test.get_result(), test.get_outcome(), test.get_metrics(), test.get_elapsed(), \
+        test.get_mismatch()
+
+
+def can_run_in_parallel():
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def _wait_for_run(run, owners, i, timeout):
+    """
+        The result of test i's task, or None if the worker running it died (the pool replaces it without a word,
+        so the task would never finish) or it didn't finish within timeout
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while not run.ready():
+        if owners[i] != 0 and owners[i] not in {process.pid for process in multiprocessing.active_children()}:
+            # in case it died just after sending its result
+            run.wait(WORKER_POLL)
+            return run.get() if run.ready() else None
+        wait = WORKER_POLL if deadline is None else min(WORKER_POLL, deadline - time.monotonic())
+        if wait <= 0:
+            return None
+        run.wait(wait)
+    return run.get()
+
+
+def run_tests_in_parallel(fn, tests, workers=None, instrumented=False):
+    """
+        Runs every test across a pool of forked worker processes, so fn must not rely on state
+        shared between calls. Results are recorded on the tests in their original order.
+        Falls back to running in order where fork isn't available.
+        A test whose worker dies, or doesn't answer within its time limit plus WORKER_GRACE, fails with LostRun
+    """
+    if not can_run_in_parallel() or workers == 1 or len(tests) < 2:
+        return [test.run(fn, instrumented) for test in tests]
+
+    context = multiprocessing.get_context("fork")
+    owners = context.Array("l", len(tests), lock=False)
+    with context.Pool(workers, initializer=_share_tests, initargs=(fn, tests, instrumented, owners)) as pool:
+        # a task per test, so a worker that dies only loses the test it was running
+        runs = [pool.apply_async(_run_shared_test, (i,)) for i in range(len(tests))]
+        for i, (test, run) in enumerate(zip(tests, runs)):
+            # tests start in order, so by the time the earlier ones are done this one has started
+            limits = test.get_limits()
+            timeout = limits.get_timeout() if limits is not None else None
+            result = _wait_for_run(run, owners, i, timeout + WORKER_GRACE if timeout is not None else None)
+            if result is None:
+                test.record_run(LostRun(), False, FAIL)
+            else:
+                test.record_run(*result[1:])
+    return [test.get_result() for test in tests]
+
+
+def _update_code_digest(digest, code):
+    digest.update(code.co_code)
+    digest.update(repr((code.co_names, code.co_varnames, code.co_freevars)).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code_digest(digest, const)
+        else:
+            digest.update(repr(const).encode())
+
+
+def _get_code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _get_code_names(const)
+    return names
+
+
+def is_plain_data(value):
+    """
+        Whether fingerprint sees all of value, rather than falling back to a repr that might hide a change
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all(is_plain_data(x) for x in value)
+    elif isinstance(value, dict):
+        return all(is_plain_data(k) and is_plain_data(v) for k, v in value.items())
+    return isinstance(value, (numbers.Number, str, bytes, type(None)))
+
+
+def function_digest(fn):
+    """
+        A hash of fn's bytecode, plus that of any functions (and classes) it uses from its globals or closure,
+        and the values of any plain data it reads, so editing a helper counts as a change to fn too
+        None if fn isn't a plain Python function, or closes over something that can't be hashed reliably
+    """
+    if not isinstance(fn, types.FunctionType):
+        return None
+    digest = hashlib.sha256()
+    seen = set()
+    pending = [fn]
+    while pending:
+        function = pending.pop()
+        if id(function) in seen:
+            continue
+        seen.add(id(function))
+        _update_code_digest(digest, function.__code__)
+        digest.update(repr(fingerprint((function.__defaults__, function.__kwdefaults__))).encode())
+        for i, cell in enumerate(function.__closure__ or ()):
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                # not assigned yet by the enclosing function
+                digest.update(f"cell{i} empty".encode())
+                continue
+            if isinstance(contents, types.FunctionType):
+                pending.append(contents)
+            elif is_plain_data(contents):
+                digest.update(f"cell{i}={fingerprint(contents)!r}".encode())
+            else:
+                return None
+        for name in sorted(_get_code_names(function.__code__)):
+            value = function.__globals__.get(name)
+            if isinstance(value, types.FunctionType):
+                pending.append(value)
+            elif isinstance(value, type) and value.__module__ == function.__module__:
+                pending.extend(v for v in vars(value).values() if isinstance(v, types.FunctionType))
+            elif isinstance(value, (numbers.Number, str, bytes, list, tuple, dict, set, frozenset, type(None))):
+                digest.update(f"{name}={fingerprint(value)!r}".encode())
+    return digest.hexdigest()
+
+
+class InputIndex:
+    """
+        Keeps track of which inputs already have a test, shared by all the TestCaseSpecs of a TestSpec
+    """
+    def __init__(self, tests=()):
+        self.__seen = set()
+        for test in tests:
+            self.add(test.get_inputs())
+
+    def add(self, inputs):
+        """
+            Returns False if these inputs were already in the index
+        """
+        key = fingerprint(inputs)
+        if key in self.__seen:
+            return False
+        self.__seen.add(key)
+        return True
+
+    def __contains__(self, inputs):
+        return fingerprint(inputs) in self.__seen
+
+    def __len__(self):
+        return len(self.__seen)
+
+
+class InputSizes:
+    def __init__(self, sizes):
+        self.__sizes = sizes
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return "n = " + ", ".join(str(size) for size in self.__sizes)
+
+
+class GrowthRate:
+    """
+        How running time grows with input size n, as the exponent k in n^k
+    """
+    def __init__(self, exponent):
+        self.__exponent = exponent
+
+    def get_exponent(self):
+        return self.__exponent
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return f"running time grows like n^{self.__exponent:.1f}"
+
+
+def time_call(func, inputs, min_time=0.01, max_calls=1000):
+    """
+        Average seconds per call, repeating small calls until at least min_time has been measured
+        Each call gets its own copy of the inputs, made outside the timed section
+    """
+    elapsed = 0
+    calls = 0
+    while elapsed < min_time and calls < max_calls:
+        fresh_inputs = copy.deepcopy(inputs)
+        start = time.perf_counter()
+        func(*fresh_inputs)
+        elapsed += time.perf_counter() - start
+        calls += 1
+    return elapsed / calls
+
+
+def fit_exponent(sizes, times):
+    """
+        Least squares slope of log(time) against log(size)
+    """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    return covariance / variance
+
+
+def measure_growth(func, sizes, inputs_per_size, repeats=3):
+    times = [min(time_call(func, inputs) for _ in range(repeats)) for inputs in inputs_per_size]
+    return GrowthRate(fit_exponent(sizes, times))
+
+
+class PerfTest(Test):
+    """
+        Passes when func's running time grows no faster than the reference solution's did,
+        give or take TOLERANCE in the exponent (timings are noisy)
+    """
+    TOLERANCE = 0.5
+    HINT = "Your code gets slower much faster than it should as the input gets bigger. " \
+           "Look for work repeated inside a loop, e.g. building a new list each time round."
+
+    def __init__(self, sizes, inputs_per_size, reference_growth, hint="", limits=None):
+        super().__init__([InputSizes(sizes)], reference_growth, hint if hint != "" else PerfTest.HINT, limits)
+        self.__sizes = sizes
+        self.__inputs_per_size = inputs_per_size
+
+    def run(self, func, instrumented=False):
+        # timing the function is this test's whole job, so instrumented makes no difference
+        try:
+            with enforce_limits(self.get_limits()):
+                growth = measure_growth(func, self.__sizes, self.__inputs_per_size)
+        except TimeLimitExceeded as e:
+            timeout = e.args[0] if e.args else self.get_limits().get_timeout()
+            self.record_run(TimedOut(timeout), False, TIMEOUT)
+            return False
+        except Exception as e:
+            data = traceback.extract_tb(sys.exc_info()[2])
+            self.record_run(PrettyError(e, data[-1][-1]), False, FAIL)
+            return False
+
+        result = growth.get_exponent() <= self.get_expected().get_exponent() + PerfTest.TOLERANCE
+        self.record_run(growth, result, PASS if result else FAIL)
+        return result
+
+
 def nth_word(s, n):
     sp = s.split()
     if n < len(sp):
@@ -98,11 +885,87 @@ def nth_word(s, n):
         return ""
 
 
+def _reject_constant(name):
+    raise ValueError(f"{name} is not a Python literal")
+
+
+def spec_namespace(rng, **names):
+    """
+        What expressions in a spec can see, with random being the stream for that line of the spec
+    """
+    return {"random": rng, "boolrange": boolrange, **names}
+
+
+class SpecExpression:
+    """
+        An input that can only be worked out when the tests are generated, e.g. one using random
+    """
+    def __init__(self, text, code):
+        self.__text = text
+        self.__code = code
+
+    def evaluate(self, rng=random):
+        return eval(self.__code, spec_namespace(rng))
+
+    def __repr__(self):
+        return self.__text
+
+
+JSON_START = frozenset('[{"-0123456789')
+JSON_WORDS = ("true", "false", "null")
+
+
+def is_json_literal(text):
+    """
+        Whether text reads the same as JSON as it does as Python, so json can be used to read it
+    """
+    text = text.lstrip()
+    if len(text) == 0 or text[0] not in JSON_START or "\\" in text:
+        return False
+    return not any(word in text for word in JSON_WORDS)
+
+
+def parse_input(text):
+    """
+        Most "eval" inputs are plain literals (lists, dicts, numbers...) which can be read without
+        running any code: json is by far the quickest for the ones it understands, then literal_eval.
+        Real expressions, e.g. using random, become a SpecExpression, parsed once.
+    """
+    # json reads some escapes differently to Python, has NaN/Infinity which Python doesn't, and
+    # true/false/null, which in a spec are names (or a typo) rather than Python's True/False/None
+    if is_json_literal(text):
+        try:
+            return json.loads(text, parse_constant=_reject_constant)
+        except ValueError:
+            pass
+    tree = ast.parse(text.strip(), mode="eval")
+    try:
+        return ast.literal_eval(tree)
+    except (ValueError, TypeError, SyntaxError, RecursionError):
+        return SpecExpression(text, compile(tree, "<string>", "eval"))
+
+
+def eval_input(text, rng=random):
+    value = parse_input(text)
+    if isinstance(value, SpecExpression):
+        return value.evaluate(rng)
+    return value
+
+
+def resolve_inputs(inputs, rng=random):
+    return [x.evaluate(rng) if isinstance(x, SpecExpression) else x for x in inputs]
+
+
+# the column types a plain input spec can name, anything else is eval'd as before
+INPUT_TYPES = {"int": int, "float": float, "str": str, "bool": bool, "eval": parse_input}
+
+
 class TestCaseSpec:
     def __init__(self, inputs, secret=False, hint=""):
         self.__inputs = inputs
         self.__secret = secret
         self.__hint = hint
+        self.__key = ()
 
     def get_inputs(self):
         return self.__inputs
@@ -113,12 +976,24 @@ class TestCaseSpec:
     def is_secret(self):
         return self.__secret
 
-    def add_tests(self, tests, secret_tests, func):
-        answer = func(*self.get_inputs())
+    def get_key(self):
+        """
+            Identifies this line of the spec, so it can have its own random stream (see TestSpec.generate_tests)
+        """
+        return self.__key
+
+    def set_key(self, key):
+        self.__key = key
+
+    def add_tests(self, tests, secret_tests, func, index=None, rng=random):
+        inputs = resolve_inputs(self.get_inputs(), rng)
+        if index is not None:
+            index.add(inputs)
+        answer = func(*inputs)
         if not self.is_secret():
-            tests.append(Test(self.get_inputs(), answer, self.get_hint()))
+            tests.append(Test(inputs, answer, self.get_hint()))
         else:
-            secret_tests.append(Test(self.get_inputs(), answer, self.get_hint()))
+            secret_tests.append(Test(inputs, answer, self.get_hint()))
 
 
 class RandomTestCaseSpec(TestCaseSpec):
@@ -126,16 +1001,21 @@ class RandomTestCaseSpec(TestCaseSpec):
         super().__init__(inputs, secret, hint)
         self.__repeats = repeats
 
-    def add_tests(self, tests, secret_tests, func):
-        previous_inputs = [test.get_inputs() for test in tests]
-        previous_inputs.extend([test.get_inputs() for test in secret_tests])
+    def add_tests(self, tests, secret_tests, func, index=None, rng=random):
+        if index is None:
+            index = InputIndex(tests + secret_tests)
 
-        spec = self.get_inputs()
-        spec = ["random." + i for i in spec]
+        spec = [compile("random." + i, "<string>", "eval") for i in self.get_inputs()]
+        namespace = spec_namespace(rng)
         for _ in range(self.__repeats):
-            inputs = [eval(randomspec) for randomspec in spec]
-            while inputs in previous_inputs:
-                inputs = [eval(randomspec) for randomspec in spec]
+            inputs = [eval(randomspec, namespace) for randomspec in spec]
+            draws = 1
+            while not index.add(inputs):
+                if draws >= MAX_DUPLICATE_DRAWS:
+                    raise RuntimeError(f"Can't find {self.__repeats} different inputs for random line "
+                                       f"\"{';'.join(self.get_inputs())}\", ask for fewer")
+                inputs = [eval(randomspec, namespace) for randomspec in spec]
+                draws += 1
             answer = func(*inputs)
             if not self.is_secret():
                 tests.append(Test(inputs, answer))
@@ -144,34 +1024,58 @@ class RandomTestCaseSpec(TestCaseSpec):
 
 
 class RangeTestCaseSpec(TestCaseSpec):
+    def __init__(self, inputs, secret=False, hint="", cap=None):
+        super().__init__(inputs, secret, hint)
+        self.__cap = cap
 
     # e.g. input [range(0,10), range(0,10)]
     #            [range(0,10)]
     #            [(1,), range(0,10)]
+    # yields one list of inputs at a time, rather than building the whole product
     @staticmethod
     def __get_range_specs(specs):
-        if len(specs) == 1:
-            return [[spec] for spec in specs[0]]
-        else:
-            return [[x, *spec] for x in specs[0] for spec in RangeTestCaseSpec.__get_range_specs(specs[1:])]
+        for inputs in itertools.product(*specs):
+            yield list(inputs)
+
+    # when the product is bigger than the cap, split it into cap equal strata
+    # and pick one combination at random from each, so the whole grid is still covered
+    @staticmethod
+    def __get_sampled_range_specs(specs, cap, rng):
+        total = math.prod(len(spec) for spec in specs)
+        for stratum in range(cap):
+            index = rng.randrange(stratum * total // cap, (stratum + 1) * total // cap)
+            inputs = []
+            for spec in reversed(specs):
+                index, position = divmod(index, len(spec))
+                inputs.append(spec[position])
+            inputs.reverse()
+            yield inputs
 
     @staticmethod
     def __iterableify(obj):
-        if isinstance(obj, Iterable):
+        if isinstance(obj, Sequence):
             return obj
+        elif isinstance(obj, Iterable):
+            # sampling needs len() and indexing
+            return tuple(obj)
         else:
             return (obj,)
 
-    def add_tests(self, tests, secret_tests, func):
-        previous_inputs = [test.get_inputs() for test in tests]
-        previous_inputs.extend([test.get_inputs() for test in secret_tests])
+    def get_cap(self):
+        return self.__cap
 
-        specs = self.get_inputs()
-        specs = [self.__iterableify(spec) for spec in specs]
-        specs = self.__get_range_specs(specs)
+    def add_tests(self, tests, secret_tests, func, index=None, rng=random):
+        if index is None:
+            index = InputIndex(tests + secret_tests)
+
+        specs = [self.__iterableify(spec) for spec in resolve_inputs(self.get_inputs(), rng)]
+        if self.__cap is not None and math.prod(len(spec) for spec in specs) > self.__cap:
+            specs = self.__get_sampled_range_specs(specs, self.__cap, rng)
+        else:
+            specs = self.__get_range_specs(specs)
 
         for inputs in specs:
-            if inputs in previous_inputs:
+            if not index.add(inputs):
                 continue
 
             answer = func(*inputs)
@@ -181,6 +1085,31 @@ class RangeTestCaseSpec(TestCaseSpec):
                 secret_tests.append(Test(inputs, answer, self.get_hint()))
 
 
+class MatrixTestCaseSpec(TestCaseSpec):
+    # e.g. input [(100, 100, "randrange", -10, 10)]
+    def add_tests(self, tests, secret_tests, func, index=None, rng=random):
+        inputs = [MatrixInput(*spec, rng.getrandbits(64)) for spec in self.get_inputs()]
+        if index is not None:
+            index.add(inputs)
+        answer = func(*materialise_inputs(inputs))
+        if not self.is_secret():
+            tests.append(Test(inputs, answer, self.get_hint()))
+        else:
+            secret_tests.append(Test(inputs, answer, self.get_hint()))
+
+
+class PerfTestCaseSpec(TestCaseSpec):
+    def __init__(self, inputs, sizes, hint=""):
+        super().__init__(inputs, False, hint)
+        self.__sizes = sizes
+
+    def add_tests(self, tests, secret_tests, func, index=None, rng=random):
+        inputs_per_size = [[eval(spec, spec_namespace(rng, n=size)) for spec in self.get_inputs()]
+                           for size in self.__sizes]
+        growth = measure_growth(func, self.__sizes, inputs_per_size)
+        tests.append(PerfTest(self.__sizes, inputs_per_size, growth, self.get_hint()))
+
+
 class InputSpec:
     """
         An inputspec is used when reading a block of lines (TestCaseSpecs)
@@ -206,7 +1135,7 @@ class PlainInputSpec(InputSpec):
         super().__init__(secret)
         in_type = nth_word(line, 2)
         in_type = TestSpec.split_and_strip(in_type)
-        self.__types = [eval(x) for x in in_type]
+        self.__types = [INPUT_TYPES[x] if x in INPUT_TYPES else eval(x) for x in in_type]
 
     def format(self, line):
         line_sp = line.split(" : ")
@@ -247,27 +1176,89 @@ class RangeInputSpec(InputSpec):
         *in range
         range(0,10);range(5,10)
         boolrange;boolrange
+
+        An optional cap samples that many combinations (spread evenly over all of them)
+        whenever a line would generate more:
+        *in range 1000
+        range(0,1000);range(0,1000)
     """
+    def __init__(self, line, secret=False):
+        super().__init__(secret)
+        # some specs name the input type after "range", which is ignored
+        caps = [word for word in line.split()[2:] if word.isdigit()]
+        self.__cap = int(caps[0]) if caps else None
+
     def format(self, line):
         inputs = TestSpec.split_and_strip(line)
-        inputs = [eval(x) for x in inputs]
-        return RangeTestCaseSpec(inputs, self.is_secret())
+        # e.g. range(0,10) becomes a SpecExpression, worked out with the line's own stream when generating
+        inputs = [parse_input(x) for x in inputs]
+        return RangeTestCaseSpec(inputs, self.is_secret(), cap=self.__cap)
+
+
+class MatrixInputSpec(InputSpec):
+    """
+        Each input is a rows x cols list of lists of random numbers, from randrange or uniform
+        Will look like this:
+        *in secret_matrix
+        100x100 randrange(-1e15,1e15)
+        3x4 uniform(0,1);2x2 randrange(0,10) : Check your loops use the right lengths
+    """
+    PATTERN = re.compile(r"(\d+)\s*x\s*(\d+)\s+(\w+)\((.+),(.+)\)$")
+
+    def format(self, line):
+        line_sp = line.split(" : ")
+        specs = []
+        for matrix in TestSpec.split_and_strip(line_sp[0]):
+            match = MatrixInputSpec.PATTERN.match(matrix)
+            if match is None:
+                raise RuntimeError("Didn't recognise matrix, expected e.g. 10x10 randrange(0,10)")
+            rows, cols, distribution, low, high = match.groups()
+            specs.append((int(rows), int(cols), distribution, eval_input(low), eval_input(high)))
+        if len(line_sp) > 1:
+            return MatrixTestCaseSpec(specs, secret=self.is_secret(), hint=line_sp[1])
+        else:
+            return MatrixTestCaseSpec(specs, secret=self.is_secret())
+
+
+class PerfInputSpec(InputSpec):
+    """
+        Each line gives expressions for the inputs in terms of the size n
+        The student's function is timed at each size and must scale like the *code solution
+        Will look like this:
+        *perf 500;1000;2000;4000
+        {i: i ^ 1 for i in range(n)} : Don't rebuild the list of keys every time round the loop
+    """
+    def __init__(self, line):
+        super().__init__(False)
+        self.__sizes = [int(size) for size in TestSpec.split_and_strip(line.split(maxsplit=1)[1])]
+
+    def format(self, line):
+        line_sp = line.split(" : ")
+        inputs = TestSpec.split_and_strip(line_sp[0])
+        if len(line_sp) > 1:
+            return PerfTestCaseSpec(inputs, self.__sizes, hint=line_sp[1])
+        else:
+            return PerfTestCaseSpec(inputs, self.__sizes)
 
 
 class TestSpec:
     SEP = ";"
-    MODES = {"name", "in", "code"}
+    MODES = {"name", "in", "code", "limits", "perf", "compare"}
 
     def __init__(self, filename):
         self.__inspecs = []
         self.__code = ""
+        self.__limits = TestLimits()
+        self.__compare = []
         with open(filename, "r") as text_file:
             lines = text_file.readlines()
         self.__parse(lines)
+        self.__comparator = parse_comparator(self.__compare)
 
     def __parse(self, text_lines):
         mode = None
         in_spec = None
+        occurrences = {}
 
         for line in text_lines:
             line = line.rstrip()
@@ -295,44 +1286,198 @@ class TestSpec:
                     elif nth_word(line, 1) == "secret_random":
                         in_spec = RandomInputSpec(line, True)
                     elif nth_word(line, 1) == "range":
-                        in_spec = RangeInputSpec(False)
+                        in_spec = RangeInputSpec(line, False)
                     elif nth_word(line, 1) == "secret_range":
-                        in_spec = RangeInputSpec(True)
+                        in_spec = RangeInputSpec(line, True)
+                    elif nth_word(line, 1) == "matrix":
+                        in_spec = MatrixInputSpec(False)
+                    elif nth_word(line, 1) == "secret_matrix":
+                        in_spec = MatrixInputSpec(True)
                     else:
                         raise RuntimeError("Didn't recognise input format")
+                elif word == "perf":
+                    in_spec = PerfInputSpec(line)
 
             elif mode is None:
                 raise RuntimeError("Need *mode before data")
             elif mode == "name":
                 self.__name = line
-            elif mode == "in":
-                self.__inspecs.append(in_spec.format(line))
+            elif mode == "in" or mode == "perf":
+                test_case_spec = in_spec.format(line)
+                # keyed by the line itself (and how many times it has appeared), rather than its position,
+                # so that adding a line to the spec doesn't change the tests generated from the others
+                occurrences[line] = occurrences.get(line, 0) + 1
+                test_case_spec.set_key((mode, line, occurrences[line]))
+                self.__inspecs.append(test_case_spec)
+            elif mode == "limits":
+                self.__parse_limit(line)
+            elif mode == "compare":
+                self.__compare.append(line)
             elif mode == "code":
                 if self.__code == "":
                     self.__code = line
                 else:
                     self.__code += "\n" + line
 
+    def __parse_limit(self, line):
+        """
+            Will look like this:
+            *limits
+            timeout 2
+            memory 256
+        """
+        if line.strip() == "":
+            return
+        key = nth_word(line, 0)
+        value = float(nth_word(line, 1))
+        if key == "timeout":
+            self.__limits = TestLimits(value, self.__limits.get_memory())
+        elif key == "memory":
+            self.__limits = TestLimits(self.__limits.get_timeout(), value)
+        else:
+            raise RuntimeError("Didn't recognise limit")
+
     @staticmethod
     def split_and_strip(line):
         return [x.strip() for x in line.split(TestSpec.SEP)]
 
-    def generate_tests(self):
+    def get_code(self):
+        return self.__code
+
+    def get_solution_function(self):
+        namespace = {}
+        exec(self.__code, namespace)
+        assert(self.__name in namespace)
+        return namespace[self.__name]
+
+    def generate_tests(self, solution_function=None, seed=SEED):
+        """
+            Each line of the spec draws from its own random stream, derived from the seed, the spec's name
+            and the line, so the same spec and seed always give the same tests, wherever they're generated
+        """
         tests = []
         secret_tests = []
 
-        exec(self.__code, locals(), locals())
-        assert(self.__name in dir())
-        solution_function = eval(self.__name)
+        if solution_function is None:
+            solution_function = self.get_solution_function()
 
+        index = InputIndex()
         for input_spec in self.__inspecs:
-            input_spec.add_tests(tests, secret_tests, solution_function)
+            rng = derive_rng(seed, self.__name, *input_spec.get_key())
+            input_spec.add_tests(tests, secret_tests, solution_function, index, rng)
+
+        if self.__limits.is_limited():
+            for test in tests + secret_tests:
+                test.add_default_limits(self.__limits)
+        if len(self.__compare) > 0:
+            for test in tests + secret_tests:
+                test.set_comparator(self.__comparator)
 
         return tests, secret_tests
 
     def get_name(self):
         return self.__name
 
+    def get_limits(self):
+        return self.__limits
+
+    def get_comparator(self):
+        """
+            How outputs are checked, from the *compare section (see comparators.parse_comparator)
+        """
+        return self.__comparator
+
+    def compile(self, seed=SEED, solution_function=None):
+        tests, secret_tests = self.generate_tests(solution_function, seed)
+        return CompiledSuite(self.get_name(), tests, secret_tests)
+
+
+class CompiledSuite:
+    """
+        Everything needed to run a spec's tests without parsing the spec or running the solution again
+    """
+    def __init__(self, name, tests, secret_tests):
+        self.__name = name
+        self.__tests = tests
+        self.__secret_tests = secret_tests
+
+    def get_name(self):
+        return self.__name
+
+    def get_tests(self):
+        return self.__tests
+
+    def get_secret_tests(self):
+        return self.__secret_tests
+
+
+def spec_digest(spec_bytes, seed=SEED):
+    """
+        The suite cache key. Matrix inputs come out differently with and without numpy (and maybe between
+        numpy versions), so a suite compiled with one can't be used with another.
+    """
+    digest = hashlib.sha256(spec_bytes)
+    digest.update(f"seed={seed};version={CACHE_VERSION};matrices={MATRIX_BACKEND}".encode())
+    return digest.hexdigest()
+
+
+def get_cache_filename(filename):
+    directory, base = os.path.split(filename)
+    return os.path.join(directory, CACHE_DIR, base + ".pickle")
+
+
+def _read_cached_suite(cache_filename, digest):
+    try:
+        with open(cache_filename, "rb") as cache_file:
+            cached_digest, suite = pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return None
+    if cached_digest != digest:
+        return None
+    return suite
+
+
+def _write_cached_suite(cache_filename, digest, suite):
+    # write to a temporary file first so a concurrent reader never sees half a suite
+    temp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        with open(temp_filename, "wb") as cache_file:
+            pickle.dump((digest, suite), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, cache_filename)
+    except Exception:
+        # a read-only spec directory, or an expected value that can't be pickled (e.g. a lambda or a
+        # generator), just means no caching
+        pass
+    finally:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+
+
+def load_compiled_suite(filename, seed=SEED, use_cache=True, sandbox=None):
+    """
+        If there's no valid cached suite the spec is compiled, running its *code in sandbox if given
+    """
+    with open(filename, "rb") as spec_file:
+        digest = spec_digest(spec_file.read(), seed)
+
+    cache_filename = get_cache_filename(filename)
+    if use_cache:
+        suite = _read_cached_suite(cache_filename, digest)
+        if suite is not None:
+            return suite
+
+    spec = TestSpec(filename)
+    solution_function = None
+    if sandbox is not None:
+        solution_function = sandbox.function(spec.get_code(), spec.get_name())
+    suite = spec.compile(seed, solution_function)
+    if use_cache:
+        _write_cached_suite(cache_filename, digest, suite)
+    return suite
+
 
 def run():
     test_test = Test([1, 2], 3)